@@ -1,54 +1,423 @@
 import asyncio
 import base64
+import contextvars
 import json
+import random
 import re
-from typing import List, Dict, Any
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Callable, Awaitable
 
 import aiohttp
 import tonutils.client
 import tonutils.wallet
+from tonutils.utils import normalize_hash
+from tonutils.wallet.messages import TransferMessage
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from tonsdk.boc import Cell
+from sqlalchemy.exc import IntegrityError
 import time
 import os
 from dotenv import load_dotenv
 import ssl
 import certifi
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from models import JobsSessionLocal, FulfillmentJob, FulfillmentJobStage
+
 load_dotenv()
 
 # --- Константы и конфигурация ---
 FRAGMENT_HEADERS = {"User-Agent": "Mozilla/5.0", "Content-Type": "application/x-www-form-urlencoded"}
-fragment_lock = asyncio.Lock()
+FRAGMENT_DEVICE = {"platform": "browser", "appName": "telegram-wallet", "appVersion": "1",
+                   "maxProtocolVersion": 2, "features": ["SendTransaction",
+                                                         {"name": "SendTransaction", "maxMessages": 4,
+                                                          "extraCurrencySupported": True}]}
+RECIPIENT_CACHE_SIZE = int(os.getenv("RECIPIENT_CACHE_SIZE", "10000"))
+RECIPIENT_CACHE_TTL = float(os.getenv("RECIPIENT_CACHE_TTL", "3600"))
+RECIPIENT_NEGATIVE_TTL = float(os.getenv("RECIPIENT_NEGATIVE_TTL", "120"))
+STAR_BATCH_SIZE_1 = 5000
+STAR_BATCH_SIZE_2 = 5050
+# Сколько заказов одновременно проходят HTTP-шаги на одной сессии Fragment
+FRAGMENT_CONCURRENCY = int(os.getenv("FRAGMENT_CONCURRENCY", "4"))
+# Как долго считаем актуальными updateStarsBuyState / updateStarsPrices / updatePremiumState
+FRAGMENT_STATE_TTL = float(os.getenv("FRAGMENT_STATE_TTL", "300"))
 
 TONAPI_KEY = os.getenv("TONAPI_KEY", "")
+TONCENTER_API_KEY = os.getenv("TONCENTER_API_KEY", "")
 MNEMONIC = os.getenv("MNEMONIC", "").split()
 FRAGMENT_HASH = os.getenv("FRAGMENT_HASH", "")
 try:
     FRAGMENT_COOKIES = json.loads(os.getenv("FRAGMENT_COOKIES", "{}"))
 except Exception:
     FRAGMENT_COOKIES = {}
+# Пул кошельков: JSON-список [{"name", "mnemonic", "fragment_hash", "fragment_cookies"}].
+# Без него работает один шард из MNEMONIC / FRAGMENT_HASH / FRAGMENT_COOKIES.
+try:
+    WALLET_SHARDS = json.loads(os.getenv("WALLET_SHARDS", "[]"))
+except Exception as e:
+    print(f"WALLET_SHARDS не разобран, использую MNEMONIC: {e}")
+    WALLET_SHARDS = []
+
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "8"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+
+WALLET_MAX_MESSAGES = 4
+SEQNO_POLL_INTERVAL = float(os.getenv("SEQNO_POLL_INTERVAL", "0.5"))
+SEQNO_MAX_POLL_INTERVAL = float(os.getenv("SEQNO_MAX_POLL_INTERVAL", "5"))
+SEQNO_EXPIRY_GRACE = float(os.getenv("SEQNO_EXPIRY_GRACE", "10"))
+SEQNO_REBROADCAST_INTERVAL = float(os.getenv("SEQNO_REBROADCAST_INTERVAL", "3"))
+WALLET_HEALTH_INTERVAL = float(os.getenv("WALLET_HEALTH_INTERVAL", "60"))
+WALLET_MAX_FAILURES = int(os.getenv("WALLET_MAX_FAILURES", "3"))
+
+PROVIDER_HEDGE_DELAY = float(os.getenv("PROVIDER_HEDGE_DELAY", "0.5"))
+PROVIDER_EWMA_ALPHA = 0.2
+
+WATCHER_POLL_INTERVAL = float(os.getenv("WATCHER_POLL_INTERVAL", "2"))
+WATCHER_MAX_POLL_INTERVAL = float(os.getenv("WATCHER_MAX_POLL_INTERVAL", "15"))
+WATCHER_TX_LIMIT = int(os.getenv("WATCHER_TX_LIMIT", "30"))
+WATCHER_DIRECT_LOOKUP_AFTER = float(os.getenv("WATCHER_DIRECT_LOOKUP_AFTER", "30"))
+# Сколько последних подписанных сообщений помнить для сопоставления с лентой кошелька
+WATCHER_RAW_HASHES = int(os.getenv("WATCHER_RAW_HASHES", "1000"))
+
+# Оценка стоимости заказа до обращения к Fragment; уточняется по фактическим списаниям
+STAR_PRICE_TON = float(os.getenv("STAR_PRICE_TON", "0.006"))
+try:
+    PREMIUM_PRICE_TON = {int(k): float(v) for k, v in json.loads(os.getenv("PREMIUM_PRICE_TON", "{}")).items()}
+except Exception:
+    PREMIUM_PRICE_TON = {}
+PREMIUM_PRICE_TON = {3: 5.0, 6: 7.0, 12: 12.0, **PREMIUM_PRICE_TON}
+BALANCE_RESERVE_MARGIN = float(os.getenv("BALANCE_RESERVE_MARGIN", "0.1"))
+ORDER_FEE_TON = float(os.getenv("ORDER_FEE_TON", "0.05"))
+BALANCE_REFRESH_INTERVAL = float(os.getenv("BALANCE_REFRESH_INTERVAL", "30"))
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+BUY_BATCH_MAX_ITEMS = int(os.getenv("BUY_BATCH_MAX_ITEMS", "50"))
+BUY_BATCH_MAX_ROUNDS = int(os.getenv("BUY_BATCH_MAX_ROUNDS", "3"))
+# Больше заданий в очереди не принимаем: 429 с Retry-After вместо бесконечного ожидания
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "100"))
+# Сколько заказов одного кошелька одновременно могут быть отправлены и не подтверждены
+WALLET_MAX_IN_FLIGHT = int(os.getenv("WALLET_MAX_IN_FLIGHT", "8"))
+# Подписывает транзакции только процесс, владеющий этим файлом; остальные лишь принимают заказы
+WALLET_LOCK_FILE = os.getenv("WALLET_LOCK_FILE", "./wallet.lock")
+JOB_CLAIM_INTERVAL = float(os.getenv("JOB_CLAIM_INTERVAL", "0.5"))
+JOB_LEADER_RETRY = float(os.getenv("JOB_LEADER_RETRY", "5"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "86400"))
+JOB_RECOVERY_CONFIRM_TIMEOUT = float(os.getenv("JOB_RECOVERY_CONFIRM_TIMEOUT", "600"))
+
+# Куда сообщать о завершении заданий (можно переопределить callback_url в запросе)
+CALLBACK_URL = os.getenv("CALLBACK_URL", "")
+CALLBACK_RETRIES = int(os.getenv("CALLBACK_RETRIES", "5"))
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+# Встроенный режим (движок в процессе FunPay): порт HTTP-интерфейса, 0 — без HTTP
+EMBEDDED_HTTP_PORT = int(os.getenv("EMBEDDED_HTTP_PORT", "0"))
+
+
+@asynccontextmanager
+async def purchase_engine():
+    """
+    Движок покупки: шарды, прогрев и менеджер заданий. Его поднимает и HTTP-сервис,
+    и встроенный режим, в котором FunPay вызывает задания напрямую.
+    """
+    shard_tasks = await shard_pool.start()
+    # Прогрев идёт в фоне: /ready отвечает 503, пока он не закончится
+    shard_tasks.append(asyncio.create_task(readiness.warm_up()))
+    await job_manager.start()
+    try:
+        yield
+    finally:
+        await job_manager.stop()
+        await job_notifier.close()
+        for task in shard_tasks:
+            task.cancel()
+        await asyncio.gather(*shard_tasks, return_exceptions=True)
+        await shard_pool.close()
+        await http_sessions.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with purchase_engine():
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# --- HTTP-сессии ---
+class HttpSessions:
+    """
+    Долгоживущие aiohttp-сессии, по одной на внешний сервис.
+    У каждой свой коннектор: keep-alive, кэш DNS и лимит соединений на хост.
+    """
+
+    def __init__(self):
+        self._configs: Dict[str, Dict[str, Any]] = {}
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._ssl_context = ssl.create_default_context(cafile=certifi.where())
+
+    def register(self, name: str, headers: Dict[str, str] | None = None, cookies: Dict[str, str] | None = None,
+                 timeout: float = 30, limit_per_host: int = HTTP_LIMIT_PER_HOST):
+        self._configs[name] = {
+            "headers": headers or {},
+            "cookies": cookies or {},
+            "timeout": timeout,
+            "limit_per_host": limit_per_host,
+        }
+
+    def get(self, name: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(name)
+        if session is not None and not session.closed:
+            return session
+        config = self._configs[name]
+        connector = aiohttp.TCPConnector(
+            ssl=self._ssl_context,
+            limit_per_host=config["limit_per_host"],
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            headers=config["headers"],
+            cookies=config["cookies"],
+            timeout=aiohttp.ClientTimeout(total=config["timeout"]),
+        )
+        self._sessions[name] = session
+        return session
+
+    async def warm(self, name: str, url: str):
+        """Открывает keep-alive соединение заранее: DNS и TLS-рукопожатие не достаются первому заказу."""
+        async with self.get(name).get(url) as resp:
+            await resp.read()
+
+    async def close(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+
+TONAPI_HEADERS = {"accept": "application/json", "Accept-Language": "ru-RU,ru;q=0.5"}
+if TONAPI_KEY:
+    TONAPI_HEADERS["Authorization"] = f"Bearer {TONAPI_KEY}"
+
+http_sessions = HttpSessions()
+http_sessions.register("fragment", headers=FRAGMENT_HEADERS, cookies=FRAGMENT_COOKIES, timeout=30)
+http_sessions.register("tonapi", headers=TONAPI_HEADERS, timeout=15)
+http_sessions.register("toncenter", headers={"X-API-Key": TONCENTER_API_KEY} if TONCENTER_API_KEY else None, timeout=6)
+http_sessions.register("tonhub", timeout=6)
+http_sessions.register("callbacks", timeout=10)
 
-app = FastAPI()
 
 async def get_event(event_id: str):
-    async with aiohttp.ClientSession() as session:
-        url = f"https://tonapi.io/v2/events/{event_id}"
-        headers = {
-            "accept": "application/json",
-            "Accept-Language": "ru-RU,ru;q=0.5"
-        }
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                return await response.json()
+    session = http_sessions.get("tonapi")
+    url = f"https://tonapi.io/v2/events/{event_id}"
+    async with session.get(url) as response:
+        if response.status == 200:
+            return await response.json()
+        else:
+            return None
+
+
+async def get_event_toncenter(event_id: str) -> Dict[str, Any] | None:
+    """Тот же статус транзакции через toncenter v3, в формате событий tonapi."""
+    session = http_sessions.get("toncenter")
+    url = "https://toncenter.com/api/v3/transactionsByMessage"
+    async with session.get(url, params={"msg_hash": event_id, "direction": "in"}) as resp:
+        if resp.status != 200:
+            return None
+        data = await resp.json()
+    transactions = (data or {}).get("transactions") or []
+    if not transactions:
+        return None
+    tx = transactions[0]
+    description = tx.get("description") or {}
+    compute_ok = (description.get("compute_ph") or {}).get("success", False)
+    action_ok = (description.get("action") or {}).get("success", True)
+    ok = not description.get("aborted", False) and compute_ok and action_ok
+    return {"event_id": tx.get("hash"), "actions": [{"status": "ok" if ok else "failed"}], "source": "toncenter"}
+
+
+async def fetch_seqno_toncenter_v3(address: str) -> int | None:
+    url = f"https://toncenter.com/api/v3/wallet?address={address}"
+    try:
+        session = http_sessions.get("toncenter")
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json()
+            return int(data.get("seqno")) if data and "seqno" in data else None
+    except Exception:
+        return None
+
+async def fetch_seqno_tonhub_v4(address: str) -> int | None:
+    try:
+        session = http_sessions.get("tonhub")
+        async with session.get("https://mainnet-v4.tonhubapi.com/block/latest") as r1:
+            if r1.status != 200:
+                return None
+            latest = await r1.json()
+            mc = latest.get("last") or latest.get("seqno")
+            if isinstance(mc, dict):
+                seqno_block = mc.get("seqno")
             else:
+                seqno_block = mc
+            if not seqno_block:
+                return None
+        async with session.get(
+                f"https://mainnet-v4.tonhubapi.com/block/{seqno_block}/{address}/run/seqno"
+        ) as r2:
+            if r2.status != 200:
+                return None
+            data = await r2.json()
+            if data and "result" in data and isinstance(data["result"], list) and data["result"]:
+                val = data["result"][0]
+                if isinstance(val, dict) and val.get("type") == "int":
+                    return int(val.get("value"))
+        return None
+    except Exception:
+        return None
+
+
+async def fetch_seqno_tonapi(address: str) -> int | None:
+    try:
+        session = http_sessions.get("tonapi")
+        async with session.get(f"https://tonapi.io/v2/wallet/{address}/seqno") as resp:
+            if resp.status != 200:
                 return None
+            data = await resp.json()
+            return int(data["seqno"]) if data and "seqno" in data else None
+    except Exception:
+        return None
+
+
+# --- Провайдеры TON: хеджированные запросы и адаптивный опрос ---
+def adaptive_intervals(initial: float = 1.0, maximum: float = 15.0, factor: float = 1.6, jitter: float = 0.2):
+    """Интервалы опроса: часто сразу после отправки, затем с ростом до maximum и с джиттером."""
+    interval = min(initial, maximum)
+    while True:
+        yield interval * random.uniform(1 - jitter, 1 + jitter)
+        interval = min(maximum, interval * factor)
+
+
+class ProviderStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.latency: float | None = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.last_error: str | None = None
+
+    def record(self, ok: bool, latency: float, error: str | None = None):
+        self.requests += 1
+        if ok:
+            self.latency = latency if self.latency is None else (
+                PROVIDER_EWMA_ALPHA * latency + (1 - PROVIDER_EWMA_ALPHA) * self.latency
+            )
+        else:
+            self.errors += 1
+            self.last_error = error
+        self.error_rate = PROVIDER_EWMA_ALPHA * (0.0 if ok else 1.0) + (1 - PROVIDER_EWMA_ALPHA) * self.error_rate
+
+    @property
+    def score(self) -> float:
+        latency = self.latency if self.latency is not None else 1.0
+        return latency * (1 + 4 * self.error_rate)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "latency": self.latency,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class ProviderPool:
+    """
+    Набор взаимозаменяемых бэкендов для одного запроса.
+    Сначала спрашивает самого здорового, и если он не ответил за hedge-задержку,
+    параллельно подключает следующих. Побеждает первый непустой ответ.
+    """
+
+    def __init__(self, providers: Dict[str, Callable[..., Awaitable[Any]]], hedge_delay: float = PROVIDER_HEDGE_DELAY):
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self.stats = {name: ProviderStats(name) for name in providers}
+
+    def _ordered(self) -> List[str]:
+        return sorted(self.providers, key=lambda name: self.stats[name].score)
+
+    async def _call(self, name: str, *args, **kwargs) -> Any:
+        started = time.monotonic()
+        try:
+            result = await self.providers[name](*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats[name].record(False, time.monotonic() - started, str(e))
+            return None
+        self.stats[name].record(result is not None, time.monotonic() - started, None if result is not None else "empty")
+        return result
+
+    async def query(self, *args, **kwargs) -> Any:
+        remaining = self._ordered()
+        best = self.stats[remaining[0]]
+        delay = min(self.hedge_delay, max(0.1, 1.5 * best.latency)) if best.latency else self.hedge_delay
+        running: Dict[asyncio.Task, str] = {}
+        try:
+            while remaining or running:
+                if remaining and (not running or len(running) < len(self.providers)):
+                    name = remaining.pop(0)
+                    running[asyncio.create_task(self._call(name, *args, **kwargs))] = name
+                done, _ = await asyncio.wait(running, timeout=delay if remaining else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    running.pop(task)
+                    if task.result() is not None:
+                        return task.result()
+            return None
+        finally:
+            for task in running:
+                task.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: self.stats[name].to_dict() for name in self._ordered()}
+
+
+seqno_providers = ProviderPool({
+    "toncenter_v3": fetch_seqno_toncenter_v3,
+    "tonhub_v4": fetch_seqno_tonhub_v4,
+    "tonapi": fetch_seqno_tonapi,
+})
+
+event_providers = ProviderPool({
+    "tonapi": get_event,
+    "toncenter_v3": get_event_toncenter,
+})
+
+
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_NBSP_RE = re.compile(r"&nbsp;?")
 
 
 def strip_html_tags(text: str) -> str:
-    text = re.sub(r"<[^>]+>", "", text)
-    text = re.sub(r"&nbsp;?", " ", text)
+    # Большинство строк без разметки: обходимся без регулярных выражений
+    if "<" in text:
+        text = _HTML_TAG_RE.sub("", text)
+    if "&nbsp" in text:
+        text = _NBSP_RE.sub(" ", text)
     return text.strip()
 
 
@@ -90,15 +459,207 @@ def decode_payload_b64_premium(payload: str) -> str:
         return f"decode_error: {e}"
 
 
+class PendingMessage:
+    def __init__(self, seqno: int, msg_hash: str, boc: str, valid_until: int):
+        self.seqno = seqno
+        self.msg_hash = msg_hash
+        self.boc = boc
+        self.valid_until = valid_until
+        self.sent_at = time.time()
+        self.broadcasts = 1
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class SeqnoManager:
+    """
+    Локальный владелец seqno кошелька.
+    acquire() сразу выдаёт следующий номер, фоновая сверка с сетью подтверждает
+    отправленные сообщения, пересылает те, что пришли раньше своей очереди,
+    и находит пропуски и просроченные сообщения.
+    """
+
+    def __init__(self, fetch_seqno: Callable[[], Awaitable[int | None]], broadcast: Callable[[str], Awaitable[Any]],
+                 poll_interval: float = SEQNO_POLL_INTERVAL, max_poll_interval: float = SEQNO_MAX_POLL_INTERVAL):
+        self._fetch_seqno = fetch_seqno
+        self._broadcast = broadcast
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._intervals = adaptive_intervals(poll_interval, max_poll_interval)
+        self.next_seqno: int | None = None
+        self.chain_seqno: int | None = None
+        self.pending: Dict[int, PendingMessage] = {}
+        self._reserved: set[int] = set()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.stats = {"confirmed": 0, "expired": 0, "gaps": 0, "rebroadcasts": 0, "resyncs": 0,
+                      "stale_reads": 0}
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.pending or self._reserved)
+
+    async def acquire(self) -> int:
+        async with self._lock:
+            if self.next_seqno is None or not self.busy:
+                # Кошелёк простаивает: сверяемся с сетью на случай внешних отправок
+                await self._resync()
+            seqno = self._hole()
+            if seqno is None:
+                seqno = self.next_seqno
+                self.next_seqno += 1
+            self._reserved.add(seqno)
+            return seqno
+
+    def _hole(self) -> int | None:
+        """
+        Номер, на котором остановилась сеть, когда сообщение с ним просрочено, а за ним
+        ещё ждут подписанные. Новое сообщение с этим номером пропускает их в блок.
+        """
+        chain = self.chain_seqno
+        if chain is None or self.next_seqno is None or chain >= self.next_seqno:
+            return None
+        if chain in self.pending or chain in self._reserved:
+            return None
+        return chain
+
+    def release(self, seqno: int):
+        """Номер выдан, но сообщение так и не было подписано."""
+        self._reserved.discard(seqno)
+        if self.next_seqno == seqno + 1:
+            self.next_seqno = max(seqno, self.chain_seqno or 0)
+
+    def register(self, seqno: int, msg_hash: str, boc: str, valid_until: int) -> PendingMessage:
+        self._reserved.discard(seqno)
+        pending = PendingMessage(seqno, msg_hash, boc, valid_until)
+        self.pending[seqno] = pending
+        # Новое сообщение: снова опрашиваем часто
+        self._intervals = adaptive_intervals(self.poll_interval, self.max_poll_interval)
+        self._ensure_running()
+        return pending
+
+    async def wait(self, pending: PendingMessage, timeout: float | None = None) -> str:
+        if not pending.future.done():
+            self._ensure_running()
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.future), timeout)
+        except asyncio.TimeoutError:
+            return "timeout"
+
+    def _observe(self, chain: int) -> int:
+        """
+        Запоминает seqno из сети как максимум из всех прочитанных. Отстающий узел может
+        вернуть номер ниже уже виденного — такие номера уже заняты в сети, выдавать их нельзя.
+        """
+        if self.chain_seqno is not None and chain < self.chain_seqno:
+            self.stats["stale_reads"] += 1
+            return self.chain_seqno
+        self.chain_seqno = chain
+        return chain
+
+    async def _resync(self):
+        chain = await self._fetch_seqno()
+        if chain is None:
+            if self.next_seqno is None:
+                raise RuntimeError("seqno_unavailable")
+            return
+        chain = self._observe(chain)
+        if self.next_seqno is None or chain > self.next_seqno or not self.busy:
+            if self.next_seqno is not None and chain != self.next_seqno:
+                self.stats["resyncs"] += 1
+            self.next_seqno = chain
+
+    def _resolve(self, seqno: int, status: str):
+        pending = self.pending.pop(seqno, None)
+        if pending is not None and not pending.future.done():
+            pending.future.set_result(status)
+            self.stats[status if status in ("confirmed", "expired") else "gaps"] += 1
+
+    async def reconcile(self):
+        chain = await self._fetch_seqno()
+        if chain is None:
+            return
+        chain = self._observe(chain)
+        now = time.time()
+
+        for seqno in sorted(self.pending):
+            if seqno < chain:
+                self._resolve(seqno, "confirmed")
+
+        async with self._lock:
+            if self.next_seqno is None or chain > self.next_seqno:
+                self.next_seqno = chain
+
+            head = self.pending.get(chain)
+            if head is not None and now > head.valid_until + SEQNO_EXPIRY_GRACE:
+                # Сообщение с текущим seqno уже не может попасть в блок, всё что за ним — тоже
+                self._resolve(chain, "expired")
+                head = None
+            if head is None and chain not in self._reserved:
+                # Сообщения за пропуском ещё попадут в блок, когда его заполнят (см. _hole),
+                # поэтому безопасными для повтора они становятся только после своего valid_until
+                stuck = [seqno for seqno, pending in self.pending.items()
+                         if seqno > chain and now > pending.valid_until + SEQNO_EXPIRY_GRACE]
+                for seqno in stuck:
+                    self._resolve(seqno, "gap")
+                if self.pending == {} and not self._reserved:
+                    self.next_seqno = chain
+            elif head is not None and now - head.sent_at >= SEQNO_REBROADCAST_INTERVAL:
+                # Конвейерное сообщение могло прийти раньше предыдущего и быть отброшено
+                head.sent_at = now
+                head.broadcasts += 1
+                self.stats["rebroadcasts"] += 1
+                try:
+                    await self._broadcast(head.boc)
+                except Exception:
+                    pass
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.busy:
+            await asyncio.sleep(next(self._intervals))
+            try:
+                await self.reconcile()
+            except Exception as e:
+                print(f"Ошибка сверки seqno: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "next_seqno": self.next_seqno,
+            "chain_seqno": self.chain_seqno,
+            "pending": sorted(self.pending),
+            "stats": dict(self.stats),
+        }
+
+
 class WalletManager:
     def __init__(self, api_key: str, mnemonic: List[str]):
         self.api_key = api_key
         self.mnemonic = mnemonic
         self.ton_client = None
         self.wallet = None
+        self._private_key: bytes | None = None
+        self._init_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+        self.in_flight = asyncio.Semaphore(WALLET_MAX_IN_FLIGHT)
+        self.seqno = SeqnoManager(self._fetch_own_seqno, self._broadcast)
+        self._failures = 0
+        self.last_health: Dict[str, Any] = {"ok": False, "checked_at": None, "seqno": None, "error": None}
+        self.balance: int | None = None
+        self.balance_at: float | None = None
+        # Нормализованный хэш сообщения -> хэш ячейки: in_msg.hash в ленте tonapi сырой
+        self.raw_hashes: OrderedDict[str, str] = OrderedDict()
 
     async def __aenter__(self):
-        await self.init_wallet()
+        await self.ensure_ready()
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
@@ -106,248 +667,947 @@ class WalletManager:
 
     async def init_wallet(self):
         self.ton_client = tonutils.client.TonapiClient(api_key=self.api_key)
-        self.wallet, _, _, _ = tonutils.wallet.WalletV4R2.from_mnemonic(self.ton_client, mnemonic=self.mnemonic)
+        if self._private_key is None:
+            # Вывод ключа из мнемоники дорогой, делаем его один раз за время жизни процесса
+            self.wallet, _, self._private_key, _ = tonutils.wallet.WalletV4R2.from_mnemonic(
+                self.ton_client, mnemonic=self.mnemonic
+            )
+        else:
+            self.wallet = tonutils.wallet.WalletV4R2.from_private_key(self.ton_client, self._private_key)
+
+    async def ensure_ready(self) -> "WalletManager":
+        if self.wallet is not None:
+            return self
+        async with self._init_lock:
+            if self.wallet is None:
+                await self.init_wallet()
+        return self
+
+    async def reconnect(self):
+        async with self._init_lock:
+            await self._close_client()
+            await self.init_wallet()
+            self._failures = 0
+
+    async def health_check(self) -> Dict[str, Any]:
+        try:
+            await self.ensure_ready()
+            seqno = await self._get_seqno(await self._get_wallet_address_str())
+            if seqno is None:
+                raise RuntimeError("seqno_unavailable")
+            self._failures = 0
+            self.last_health = {"ok": True, "checked_at": time.time(), "seqno": seqno, "error": None}
+            await self.fetch_balance()
+        except Exception as e:
+            self._failures += 1
+            self.last_health = {"ok": False, "checked_at": time.time(), "seqno": None, "error": str(e)}
+            if self._failures >= WALLET_MAX_FAILURES:
+                try:
+                    await self.reconnect()
+                except Exception as reconnect_error:
+                    self.last_health["error"] = str(reconnect_error)
+        return self.last_health
+
+    async def health_loop(self, interval_seconds: float = WALLET_HEALTH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            await self.health_check()
+
+    async def balance_loop(self, interval_seconds: float = BALANCE_REFRESH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            if self.wallet is not None:
+                await self.fetch_balance()
+
+    def spent(self, amount_ton: float):
+        """Списание, которое кэш баланса ещё не видел: учитываем до следующего обновления."""
+        if self.balance is not None:
+            self.balance = max(0, self.balance - int(amount_ton * 1e9))
 
     async def _get_wallet_address_str(self) -> str:
         addr_raw = str(self.wallet.address)
         return addr_raw.replace('Address<', '').replace('>', '')
 
-    async def _fetch_seqno_toncenter_v3(self, address: str) -> int | None:
-        url = f"https://toncenter.com/api/v3/wallet?address={address}"
+    async def fetch_balance(self) -> int | None:
+        """Баланс в нанотонах; при ошибке остаётся прежнее значение."""
         try:
-            timeout = aiohttp.ClientTimeout(total=6)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url) as resp:
-                    if resp.status != 200:
-                        return None
+            session = http_sessions.get("tonapi")
+            address = await self._get_wallet_address_str()
+            async with session.get(f"https://tonapi.io/v2/accounts/{address}") as resp:
+                if resp.status == 200:
                     data = await resp.json()
-                    return int(data.get("seqno")) if data and "seqno" in data else None
-        except Exception:
-            return None
+                    self.balance = int(data.get("balance", 0))
+                    self.balance_at = time.time()
+        except Exception as e:
+            print(f"Не удалось получить баланс кошелька: {e}")
+        return self.balance
 
-    async def _fetch_seqno_tonhub_v4(self, address: str) -> int | None:
+    async def _get_seqno(self, address: str) -> int | None:
+        return await seqno_providers.query(address)
+
+    async def _fetch_own_seqno(self) -> int | None:
+        await self.ensure_ready()
+        return await self._get_seqno(await self._get_wallet_address_str())
+
+    async def _broadcast(self, boc: str):
+        await self.ton_client.send_message(boc)
+
+    @staticmethod
+    def _resolve_body(payload: str) -> Any:
         try:
-            timeout = aiohttp.ClientTimeout(total=6)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get("https://mainnet-v4.tonhubapi.com/block/latest") as r1:
-                    if r1.status != 200:
-                        return None
-                    latest = await r1.json()
-                    mc = latest.get("last") or latest.get("seqno")
-                    if isinstance(mc, dict):
-                        seqno_block = mc.get("seqno")
-                    else:
-                        seqno_block = mc
-                    if not seqno_block:
-                        return None
-                async with session.get(
-                        f"https://mainnet-v4.tonhubapi.com/block/{seqno_block}/{address}/run/seqno"
-                ) as r2:
-                    if r2.status != 200:
-                        return None
-                    data = await r2.json()
-                    if data and "result" in data and isinstance(data["result"], list) and data["result"]:
-                        val = data["result"][0]
-                        if isinstance(val, dict) and val.get("type") == "int":
-                            return int(val.get("value"))
-            return None
+            if payload and ("Telegram Premium" in payload or re.fullmatch(r"[A-Za-z0-9+/=_-]+", payload) is None):
+                return payload
+            return decode_payload(payload)
         except Exception:
-            return None
-
-    async def _get_seqno(self, address: str) -> int | None:
-        seqno = await self._fetch_seqno_toncenter_v3(address)
-        if seqno is not None:
-            return seqno
-        return await self._fetch_seqno_tonhub_v4(address)
-
-    async def _wait_for_seqno_increase(self, address: str, previous_seqno: int, timeout_seconds: int = 60,
-                                       poll_interval: float = 1.0) -> bool:
-        deadline = time.time() + timeout_seconds
-        while time.time() < deadline:
-            await asyncio.sleep(poll_interval)
-            current = await self._get_seqno(address)
-            if current is not None and current > previous_seqno:
-                return True
-        return False
+            return decode_payload(payload)
 
     async def transfer(self, destination: str, amount_nano: int, payload: str,
                        ttl_seconds: int = 60, max_retries: int = 2) -> Dict[str, Any]:
-        result: Dict[str, Any] = {
-            "address": destination,
-            "amount": amount_nano,
+        results = await self.transfer_batch(
+            [{"address": destination, "amount": amount_nano, "payload": payload}],
+            ttl_seconds=ttl_seconds, max_retries=max_retries,
+        )
+        return results[0]
+
+    async def transfer_batch(self, messages: List[Dict[str, Any]], ttl_seconds: int = 60,
+                             max_retries: int = 2) -> List[Dict[str, Any]]:
+        """
+        Отправляет сообщения транзакции Fragment одним внешним сообщением кошелька
+        (до WALLET_MAX_MESSAGES за раз) с одним ожиданием seqno на пачку.
+        """
+        results: List[Dict[str, Any]] = [{
+            "address": msg["address"],
+            "amount": msg["amount"],
             "success": False,
             "tx_hash": None,
             "error": None,
             "attempts": 0,
-        }
+        } for msg in messages]
+
+        starts = list(range(0, len(messages), WALLET_MAX_MESSAGES))
+        # Пачки подписываются по очереди под _send_lock, а подтверждения ждём параллельно.
+        # in_flight ограничивает длину цепочки неподтверждённых seqno: просрочка головы рвёт всю цепочку
+        async with self.in_flight:
+            outcomes = await asyncio.gather(*[
+                self._send_chunk(messages[start:start + WALLET_MAX_MESSAGES], ttl_seconds, max_retries)
+                for start in starts
+            ])
+        for start, outcome in zip(starts, outcomes):
+            for result in results[start:start + WALLET_MAX_MESSAGES]:
+                result.update(outcome)
+
+        return results
+
+    async def _sign_and_send(self, transfer_messages: List[TransferMessage], ttl_seconds: int) -> PendingMessage:
+        async with self._send_lock:
+            return await self._sign_and_send_locked(transfer_messages, ttl_seconds)
+
+    async def _sign_and_send_locked(self, transfer_messages: List[TransferMessage], ttl_seconds: int) -> PendingMessage:
+        seqno = await self.seqno.acquire()
         try:
-            if payload and ("Telegram Premium" in payload or re.fullmatch(r"[A-Za-z0-9+/=_-]+", payload) is None):
-                body_obj: Any = payload
-            else:
-                body_obj: Any = decode_payload(payload)
+            valid_until = int(time.time()) + ttl_seconds
+            wallet_messages = [await message.build(self.wallet) for message in transfer_messages]
+            body = self.wallet.raw_create_transfer_msg(
+                private_key=self.wallet.private_key,
+                messages=wallet_messages,
+                seqno=seqno,
+                valid_until=valid_until,
+            )
+            state_init = self.wallet.state_init if seqno == 0 else None
+            message = self.wallet.create_external_msg(dest=self.wallet.address, body=body, state_init=state_init)
+            cell = message.serialize()
+            boc = cell.to_boc().hex()
+            msg_hash = normalize_hash(message).hex()
+            raw_hash = cell.hash.hex()
+            self.raw_hashes[msg_hash] = raw_hash
+            while len(self.raw_hashes) > WATCHER_RAW_HASHES:
+                self.raw_hashes.popitem(last=False)
         except Exception:
-            body_obj = decode_payload(payload)
-
+            self.seqno.release(seqno)
+            raise
+        pending = self.seqno.register(seqno, msg_hash, boc, valid_until)
+        # Хэш и seqno сохраняются до отправки: после падения по ним сверяемся с сетью, а не покупаем заново
+        hook = on_signed.get()
+        if hook is not None:
+            hook(msg_hash, raw_hash)
+        set_job_stage("signed", seqno=seqno, tx_hash=msg_hash, raw_hash=raw_hash)
         try:
-            wallet_address = await self._get_wallet_address_str()
-            previous_seqno = await self._get_seqno(wallet_address) or 0
-
-            attempts = 0
-            last_error: str | None = None
-            while attempts <= max_retries:
-                attempts += 1
-                result["attempts"] = attempts
+            await self._broadcast(boc)
+        except Exception as e:
+            # Сообщение уже учтено: сверка перешлёт его или пометит просроченным
+            print(f"Ошибка отправки сообщения seqno={seqno}: {e}")
+        return pending
+
+    async def _send_chunk(self, chunk: List[Dict[str, Any]], ttl_seconds: int, max_retries: int) -> Dict[str, Any]:
+        outcome: Dict[str, Any] = {"success": False, "tx_hash": None, "seqno": None, "error": None, "attempts": 0}
+        transfer_messages = [
+            TransferMessage(destination=msg["address"], amount=msg["amount"],
+                            body=self._resolve_body(msg.get("payload", "")))
+            for msg in chunk
+        ]
+
+        attempts = 0
+        last_error: str | None = None
+        while attempts <= max_retries:
+            attempts += 1
+            outcome["attempts"] = attempts
+            try:
+                pending = await self._sign_and_send(transfer_messages, ttl_seconds)
+                outcome["tx_hash"] = pending.msg_hash
+                outcome["seqno"] = pending.seqno
+
+                status = await self.seqno.wait(pending, timeout=ttl_seconds + SEQNO_EXPIRY_GRACE * 3)
+                if status == "confirmed":
+                    outcome["success"] = True
+                    last_error = None
+                    break
+                last_error = f"seqno_{status}"
+                if status == "timeout":
+                    # Сообщение ещё может попасть в блок, повторная подпись дала бы двойную оплату
+                    break
+
+            except Exception as e:
+                last_error = str(e)
+                await asyncio.sleep(1.0)
                 try:
-                    valid_until = int(time.time()) + ttl_seconds
-                    try:
-                        tx_hash = await self.wallet.transfer(
-                            destination=destination,
-                            amount=amount_nano,
-                            body=body_obj,
-                            valid_until=valid_until,
-                        )
-                    except TypeError:
-                        tx_hash = await self.wallet.transfer(
-                            destination=destination,
-                            amount=amount_nano,
-                            body=body_obj,
-                        )
-
-                    result["tx_hash"] = tx_hash
-
-                    confirmed = await self._wait_for_seqno_increase(
-                        wallet_address, previous_seqno, timeout_seconds=ttl_seconds
-                    )
-                    if confirmed:
-                        result["success"] = True
-                        last_error = None
-                        break
-                    else:
-                        last_error = "seqno_not_increased_within_ttl"
-                        current_seqno = await self._get_seqno(wallet_address)
-                        previous_seqno = current_seqno if current_seqno is not None else previous_seqno
-                        continue
+                    await self.reconnect()
+                except Exception:
+                    pass
 
-                except Exception as e:
-                    last_error = str(e)
-                    await asyncio.sleep(1.0)
-                    continue
+        if not outcome["success"] and last_error:
+            outcome["error"] = last_error
 
-            if not result["success"] and last_error:
-                result["error"] = last_error
+        return outcome
 
+    async def _close_client(self):
+        if self.ton_client and hasattr(self.ton_client, "_session"):
+            await self.ton_client._session.close()
+
+    async def close(self):
+        await self.seqno.stop()
+        await self._close_client()
+
+
+async def get_wallet_manager() -> WalletManager:
+    return await get_shard().wallet.ensure_ready()
+
+
+async def fetch_wallet_transactions(address: str, limit: int = 20) -> List[Dict[str, Any]]:
+    session = http_sessions.get("tonapi")
+    url = f"https://tonapi.io/v2/blockchain/accounts/{address}/transactions"
+    async with session.get(url, params={"limit": str(limit), "sort_order": "desc"}) as resp:
+        if resp.status != 200:
+            return []
+        data = await resp.json()
+    return (data or {}).get("transactions") or []
+
+
+class Singleflight:
+    """Склеивает одновременные запросы с одинаковым ключом в один вызов."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+
+event_lookups = Singleflight()
+
+
+async def lookup_event(event_id: str) -> Dict[str, Any] | None:
+    return await event_lookups.do(event_id, lambda: event_providers.query(event_id))
+
+
+def _event_final(event: Dict[str, Any] | None) -> bool:
+    actions = (event or {}).get("actions") or []
+    return bool(actions) and actions[0].get("status") in ("ok", "failed")
+
+
+class WatchEntry:
+    def __init__(self, event_id: str, raw_hash: str | None = None):
+        self.event_id = event_id
+        self.raw_hash = raw_hash
+        self.added_at = time.time()
+        self.last_lookup = 0.0
+        self.futures: List[asyncio.Future] = []
+
+
+class ConfirmationWatcher:
+    """
+    Один фоновый наблюдатель за всеми ожидающими транзакциями.
+    За тик читает ленту транзакций кошелька одним запросом и сопоставляет входящие
+    внешние сообщения с ожидающими хэшами. Тем, кого в ленте давно нет, делает
+    не больше одного прямого запроса события за тик.
+    """
+
+    def __init__(self, wallet: "WalletManager", poll_interval: float = WATCHER_POLL_INTERVAL,
+                 max_poll_interval: float = WATCHER_MAX_POLL_INTERVAL):
+        self.wallet = wallet
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.pending: Dict[str, WatchEntry] = {}
+        self._intervals = adaptive_intervals(poll_interval, max_poll_interval)
+        self._task: asyncio.Task | None = None
+        self.stats = {"polls": 0, "stream_matches": 0, "direct_lookups": 0, "resolved": 0,
+                      "stream_errors": 0}
+        self.last_stream_error: str | None = None
+
+    async def wait(self, event_id: str, timeout: float | None = None,
+                   raw_hash: str | None = None) -> Dict[str, Any] | None:
+        """raw_hash: хэш ячейки сообщения из журнала — после перезапуска его нет в памяти кошелька."""
+        event_id = event_id.lower()
+        raw_hash = (raw_hash or self.wallet.raw_hashes.get(event_id) or "").lower() or None
+        entry = self.pending.get(event_id)
+        if entry is None:
+            entry = self.pending[event_id] = WatchEntry(event_id, raw_hash)
+            self._intervals = adaptive_intervals(self.poll_interval, self.max_poll_interval)
+        elif entry.raw_hash is None:
+            entry.raw_hash = raw_hash
+        future = asyncio.get_running_loop().create_future()
+        entry.futures.append(future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if entry.futures and future in entry.futures:
+                entry.futures.remove(future)
+            if not entry.futures and self.pending.get(event_id) is entry:
+                del self.pending[event_id]
+
+    def _resolve(self, event_id: str, event: Dict[str, Any]):
+        entry = self.pending.pop(event_id, None)
+        if entry is None:
+            return
+        self.stats["resolved"] += 1
+        for future in entry.futures:
+            if not future.done():
+                future.set_result(event)
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(next(self._intervals))
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"Ошибка наблюдателя подтверждений: {e}")
+
+    async def poll(self):
+        if not self.pending:
+            return
+        self.stats["polls"] += 1
+        try:
+            await self.wallet.ensure_ready()
+            address = await self.wallet._get_wallet_address_str()
+            transactions = await fetch_wallet_transactions(address, limit=WATCHER_TX_LIMIT)
         except Exception as e:
-            result["error"] = str(e)
+            # Лента недоступна — прямые запросы ниже всё равно выполняем
+            self.stats["stream_errors"] += 1
+            self.last_stream_error = repr(e)
+            transactions = []
+        by_raw_hash = {e.raw_hash: e.event_id for e in self.pending.values() if e.raw_hash}
+        for tx in transactions:
+            in_msg_hash = ((tx.get("in_msg") or {}).get("hash") or "").lower()
+            event_id = by_raw_hash.get(in_msg_hash) or (in_msg_hash if in_msg_hash in self.pending else None)
+            if event_id is not None:
+                self.stats["stream_matches"] += 1
+                status = "ok" if tx.get("success") and not tx.get("aborted") else "failed"
+                self._resolve(event_id, {
+                    "event_id": tx.get("hash"),
+                    "actions": [{"status": status}],
+                    "lt": tx.get("lt"),
+                    "source": "wallet_stream",
+                })
+
+        now = time.time()
+        stale = [e for e in self.pending.values()
+                 if now - e.added_at >= WATCHER_DIRECT_LOOKUP_AFTER and now - e.last_lookup >= WATCHER_DIRECT_LOOKUP_AFTER]
+        if stale:
+            entry = min(stale, key=lambda e: e.last_lookup)
+            entry.last_lookup = now
+            self.stats["direct_lookups"] += 1
+            event = await lookup_event(entry.event_id)
+            if _event_final(event):
+                self._resolve(entry.event_id, event)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"pending": len(self.pending), "stats": dict(self.stats),
+                "last_stream_error": self.last_stream_error}
+
+
+async def check_transaction_periodically(event_id: str, interval_seconds: int = 15,
+                                         max_attempts: int = 240) -> Dict[str, Any]:
+    return await get_shard().watcher.wait(event_id, timeout=interval_seconds * max_attempts)
+
+
+class FragmentClient:
+    """
+    Долгоживущий клиент Fragment API: сессия с куками, hash и состояние покупки.
+    updateStarsBuyState / updateStarsPrices / updatePremiumState отправляются не на каждый заказ,
+    а раз в state_ttl или после того, как Fragment отверг запрос (invalidate).
+    """
+
+    STATE_REQUESTS = {
+        "stars": [
+            ("updateStarsBuyState", {"mode": "new", "lv": "false", "dh": "1", "method": "updateStarsBuyState"}),
+            ("updateStarsPrices", {"stars": "", "quantity": "", "method": "updateStarsPrices"}),
+        ],
+        "premium": [
+            ("updatePremiumState", {"mode": "new", "lv": "false", "dh": "1", "method": "updatePremiumState"}),
+        ],
+    }
 
-        return result
+    def __init__(self, session_name: str = "fragment", api_hash: str | None = FRAGMENT_HASH,
+                 state_ttl: float = FRAGMENT_STATE_TTL):
+        self.session_name = session_name
+        self.api_hash = api_hash
+        self.state_ttl = state_ttl
+        self.semaphore = asyncio.Semaphore(FRAGMENT_CONCURRENCY)
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._state_at: Dict[str, float] = {}
+        self._state_lock = asyncio.Lock()
+        self.stats = {"calls": 0, "state_refreshes": 0, "state_invalidations": 0}
+
+    async def call(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        session = http_sessions.get(self.session_name)
+        self.stats["calls"] += 1
+        async with session.post(f"https://fragment.com/api?hash={self.api_hash}", data=data) as resp:
+            return await resp.json()
+
+    def state_fresh(self, kind: str) -> bool:
+        at = self._state_at.get(kind)
+        return at is not None and time.monotonic() - at < self.state_ttl
+
+    async def ensure_state(self, kind: str) -> tuple[Dict[str, Any], bool]:
+        """Возвращает (ответы state-запросов, были ли они отправлены сейчас)."""
+        if self.state_fresh(kind):
+            return self._state[kind], False
+        async with self._state_lock:
+            # Пока ждали lock, состояние мог обновить параллельный заказ
+            if self.state_fresh(kind):
+                return self._state[kind], False
+            await self._refresh(kind)
+            return self._state[kind], True
+
+    async def _refresh(self, kind: str):
+        state = {}
+        for name, data in self.STATE_REQUESTS[kind]:
+            state[name] = await self.call(dict(data))
+        self._state[kind] = state
+        self._state_at[kind] = time.monotonic()
+        self.stats["state_refreshes"] += 1
+
+    def invalidate(self, kind: str):
+        if self._state_at.pop(kind, None) is not None:
+            self.stats["state_invalidations"] += 1
+
+    async def refresh_loop(self):
+        """Обновляет состояние заранее, чтобы заказ не ждал его после истечения TTL."""
+        while True:
+            await asyncio.sleep(max(self.state_ttl * 0.8, 1.0))
+            for kind in list(self._state_at):
+                try:
+                    async with self._state_lock:
+                        await self._refresh(kind)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.invalidate(kind)
+                    print(f"Не удалось обновить состояние Fragment ({kind}): {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "state_age": {kind: round(now - at, 1) for kind, at in self._state_at.items()},
+            "state_ttl": self.state_ttl,
+            "stats": dict(self.stats),
+        }
+
+
+class Shard:
+    """
+    Кошелёк вместе с сессией Fragment. Заказ целиком выполняется на одном шарде:
+    у каждого свой seqno и свой наблюдатель подтверждений.
+    """
+
+    def __init__(self, name: str, wallet: WalletManager, fragment: FragmentClient):
+        self.name = name
+        self.wallet = wallet
+        self.fragment = fragment
+        self.watcher = ConfirmationWatcher(wallet)
+        self.in_flight = 0
+        self.stats = {"jobs": 0}
+
+    @property
+    def healthy(self) -> bool:
+        health = self.wallet.last_health
+        return health["checked_at"] is None or health["ok"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "balance": self.wallet.balance,
+            "balance_at": self.wallet.balance_at,
+            "health": self.wallet.last_health,
+            "seqno": self.wallet.seqno.snapshot(),
+            "watcher": self.watcher.snapshot(),
+            "fragment": self.fragment.snapshot(),
+            "stats": dict(self.stats),
+        }
+
+
+current_shard: contextvars.ContextVar[Optional[Shard]] = contextvars.ContextVar("current_shard", default=None)
+
+
+class ShardPool:
+    """Раздаёт задания шардам: здоровый с наименьшим числом заказов в работе, при равенстве — с большим балансом."""
+
+    def __init__(self, shards: List[Shard]):
+        if not shards:
+            raise ValueError("shard pool is empty")
+        self.shards: Dict[str, Shard] = {shard.name: shard for shard in shards}
+        self.default = shards[0]
+
+    def pick(self, preferred: str | None = None, need_ton: float = 0.0) -> Shard:
+        # Восстановленное задание сверяется на том кошельке, которым было подписано
+        if preferred in self.shards:
+            return self.shards[preferred]
+        candidates = [shard for shard in self.shards.values() if shard.healthy] or list(self.shards.values())
+        funded = [shard for shard in candidates if balance_ledger.available(shard) >= need_ton]
+        return min(funded or candidates, key=lambda shard: (shard.in_flight, -balance_ledger.available(shard)))
+
+    @asynccontextmanager
+    async def use(self, preferred: str | None = None, need_ton: float = 0.0):
+        shard = self.pick(preferred, need_ton)
+        shard.in_flight += 1
+        shard.stats["jobs"] += 1
+        token = current_shard.set(shard)
+        try:
+            yield shard
+        finally:
+            shard.in_flight -= 1
+            current_shard.reset(token)
+
+    async def start(self) -> List[asyncio.Task]:
+        # Кошельки инициализирует прогрев (Readiness.warm_up), здесь только фоновые циклы
+        tasks = []
+        for shard in self.shards.values():
+            tasks.append(asyncio.create_task(shard.wallet.health_loop()))
+            tasks.append(asyncio.create_task(shard.wallet.balance_loop()))
+            tasks.append(asyncio.create_task(shard.fragment.refresh_loop()))
+        return tasks
 
     async def close(self):
-        if self.ton_client and hasattr(self.ton_client, "_session"):
-            await self.ton_client._session.close()
+        for shard in self.shards.values():
+            await shard.watcher.stop()
+            await shard.wallet.close()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [shard.snapshot() for shard in self.shards.values()]
+
+
+def _build_shards() -> List[Shard]:
+    configs = WALLET_SHARDS or [{"name": "main", "mnemonic": " ".join(MNEMONIC)}]
+    shards = []
+    for i, config in enumerate(configs):
+        name = str(config.get("name") or f"wallet_{i}")
+        mnemonic = config.get("mnemonic") or ""
+        mnemonic = mnemonic.split() if isinstance(mnemonic, str) else list(mnemonic)
+        api_hash = config.get("fragment_hash") or FRAGMENT_HASH
+        cookies = config.get("fragment_cookies")
+        session_name = "fragment"
+        if cookies and cookies != FRAGMENT_COOKIES:
+            # Своя сессия Fragment: отдельные куки и отдельный лимит соединений
+            session_name = f"fragment:{name}"
+            http_sessions.register(session_name, headers=FRAGMENT_HEADERS, cookies=cookies, timeout=30)
+        shards.append(Shard(name, WalletManager(TONAPI_KEY, mnemonic), FragmentClient(session_name, api_hash)))
+    return shards
+
+
+shard_pool = ShardPool(_build_shards())
+
+
+def get_shard() -> Shard:
+    return current_shard.get() or shard_pool.default
+
+
+class InsufficientBalance(Exception):
+    def __init__(self, required_ton: float, available_ton: float):
+        super().__init__(f"insufficient balance: required {required_ton:.3f} TON, available {available_ton:.3f} TON")
+        self.required_ton = required_ton
+        self.available_ton = available_ton
+
+
+class BalanceLedger:
+    """
+    Резервы TON под принятые, но не завершённые задания.
+    Доступно = кэшированный баланс кошелька - резервы заданий на нём. Резерв задания,
+    ещё не назначенного шарду, уменьшает доступное по всему пулу.
+    """
+
+    def __init__(self, pool: ShardPool, margin: float = BALANCE_RESERVE_MARGIN):
+        self.pool = pool
+        self.margin = margin
+        self._reservations: Dict[str, Dict[str, Any]] = {}
+        self.star_price_ton = STAR_PRICE_TON
+        self.premium_price_ton = dict(PREMIUM_PRICE_TON)
+        self.stats = {"reserved": 0, "rejected": 0, "released": 0}
+
+    def estimate(self, kind: str, params: Dict[str, Any]) -> float:
+        if kind == "stars_batch":
+            quantity = sum(item["quantity"] for item in params["items"])
+            return quantity * self.star_price_ton * (1 + self.margin) + ORDER_FEE_TON * len(params["items"])
+        if kind == "stars":
+            price = params["quantity"] * self.star_price_ton
+        else:
+            price = self.premium_price_ton.get(params["months"], max(self.premium_price_ton.values()))
+        return price * (1 + self.margin) + ORDER_FEE_TON
+
+    def observe(self, kind: str, params: Dict[str, Any], spent_ton: float):
+        """Фактическая стоимость выполненного заказа уточняет оценку (EWMA)."""
+        if spent_ton <= 0:
+            return
+        if kind in ("stars", "stars_batch"):
+            quantity = params["quantity"] if kind == "stars" else sum(item["quantity"] for item in params["items"])
+            self.star_price_ton += PROVIDER_EWMA_ALPHA * (spent_ton / quantity - self.star_price_ton)
+        elif params.get("months") in self.premium_price_ton:
+            current = self.premium_price_ton[params["months"]]
+            self.premium_price_ton[params["months"]] = current + PROVIDER_EWMA_ALPHA * (spent_ton - current)
+
+    def reserved(self, shard: Shard | None = None) -> float:
+        name = shard.name if shard is not None else None
+        return sum(r["amount"] for r in self._reservations.values() if name is None or r["shard"] == name)
+
+    def available(self, shard: Shard) -> float:
+        if shard.wallet.balance is None:
+            return float("inf")
+        return shard.wallet.balance / 1e9 - self.reserved(shard)
+
+    def check(self, amount_ton: float, foreign_reserved: float = 0.0):
+        shards = [shard for shard in self.pool.shards.values() if shard.wallet.balance is not None]
+        if not shards:
+            # Баланс ещё ни разу не получен: не блокируем приём заказов
+            return
+        unassigned = sum(r["amount"] for r in self._reservations.values() if r["shard"] is None)
+        total = sum(self.available(shard) for shard in shards) - unassigned - foreign_reserved
+        best = max(self.available(shard) for shard in shards) - foreign_reserved
+        if min(total, best) < amount_ton:
+            self.stats["rejected"] += 1
+            raise InsufficientBalance(amount_ton, max(0.0, min(total, best)))
+
+    def reserve(self, job_id: str, amount_ton: float):
+        if job_id not in self._reservations:
+            self._reservations[job_id] = {"amount": amount_ton, "shard": None}
+            self.stats["reserved"] += 1
+
+    def amount(self, job_id: str) -> float:
+        return self._reservations.get(job_id, {}).get("amount", 0.0)
+
+    def assign(self, job_id: str, shard: Shard):
+        if job_id in self._reservations:
+            self._reservations[job_id]["shard"] = shard.name
+
+    def release(self, job_id: str, shard: Shard | None = None, spent_ton: float = 0.0):
+        if self._reservations.pop(job_id, None) is not None:
+            self.stats["released"] += 1
+        if shard is not None and spent_ton > 0:
+            shard.wallet.spent(spent_ton)
+
+    def snapshot(self) -> Dict[str, Any]:
+        shards = []
+        for shard in self.pool.shards.values():
+            balance = shard.wallet.balance / 1e9 if shard.wallet.balance is not None else None
+            shards.append({
+                "name": shard.name,
+                "balance_ton": balance,
+                "reserved_ton": self.reserved(shard),
+                "available_ton": self.available(shard) if balance is not None else None,
+                "balance_at": shard.wallet.balance_at,
+            })
+        known = [s for s in shards if s["balance_ton"] is not None]
+        reserved = self.reserved()
+        return {
+            "shards": shards,
+            "balance_ton": sum(s["balance_ton"] for s in known) if known else None,
+            "reserved_ton": reserved,
+            "available_ton": sum(s["balance_ton"] for s in known) - reserved if known else None,
+            "reservations": len(self._reservations),
+            "prices": {"star_ton": self.star_price_ton, "premium_ton": self.premium_price_ton},
+            "stats": dict(self.stats),
+        }
 
 
-async def check_transaction_periodically(event_id: str, tag: str, quantity: int, interval_seconds: int = 15,
-                                         max_attempts: int = 240, max_send_attempts: int = 5) -> Dict[str, Any]:
-    send_attempts = 0
-    while send_attempts < max_send_attempts:
-        attempt = 0
-        while attempt < max_attempts:
-            result = await get_event(event_id)
-            if result is not None:
-                if "actions" in result and len(result["actions"]) > 0:
-                    action = result["actions"][0]
-                    if action.get("status") == "ok":
-                        return result
-                    elif action.get("status") == "failed":
-                        return result
-                elif "error" in result and result["error"] == "entity not found":
-                    send_attempts += 1
-                    if send_attempts < max_send_attempts:
-                        send_result = await buy_stars_logic_internal(tag, quantity)
-                        if send_result.get("transfers") and send_result["transfers"][0].get("event_id"):
-                            event_id = send_result["transfers"][0]["event_id"]
-                            break
-                        else:
-                            return None
-                    else:
-                        return None
-
-            attempt += 1
-            await asyncio.sleep(interval_seconds)
+balance_ledger = BalanceLedger(shard_pool)
+
+
+WARMUP_URLS = {
+    "tonapi": "https://tonapi.io/v2/status",
+    "toncenter": "https://toncenter.com/api/v3/masterchainInfo",
+    "tonhub": "https://mainnet-v4.tonhubapi.com/block/latest",
+}
+
+
+class Readiness:
+    """
+    Прогрев при старте: вывод ключей кошельков, соединения к провайдерам, seqno, баланс
+    и состояние покупки на Fragment. Неудавшиеся шаги повторяются, пока все не пройдут.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.attempts = 0
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.steps: Dict[str, Dict[str, Any]] = {}
+
+    async def _step(self, name: str, fn: Callable[[], Awaitable[Any]]) -> bool:
+        if self.steps.get(name, {}).get("ok"):
+            return True
+        started = time.monotonic()
+        try:
+            await fn()
+            self.steps[name] = {"ok": True, "seconds": round(time.monotonic() - started, 3), "error": None}
+        except Exception as e:
+            self.steps[name] = {"ok": False, "seconds": round(time.monotonic() - started, 3), "error": str(e)}
+        return self.steps[name]["ok"]
+
+    async def _warm_shard(self, shard: Shard) -> bool:
+        async def seqno():
+            await shard.wallet.seqno.reconcile()
+            if shard.wallet.seqno.chain_seqno is None:
+                raise RuntimeError("seqno_unavailable")
+
+        async def balance():
+            if await shard.wallet.fetch_balance() is None:
+                raise RuntimeError("balance_unavailable")
+
+        if not await self._step(f"{shard.name}:wallet", shard.wallet.ensure_ready):
+            return False
+        results = await asyncio.gather(
+            self._step(f"{shard.name}:seqno", seqno),
+            self._step(f"{shard.name}:balance", balance),
+            self._step(f"{shard.name}:fragment_stars", lambda: shard.fragment.ensure_state("stars")),
+            self._step(f"{shard.name}:fragment_premium", lambda: shard.fragment.ensure_state("premium")),
+        )
+        return all(results)
+
+    async def _warm_once(self) -> bool:
+        results = await asyncio.gather(
+            *[self._step(f"http:{name}", lambda name=name, url=url: http_sessions.warm(name, url))
+              for name, url in WARMUP_URLS.items()],
+            *[self._warm_shard(shard) for shard in shard_pool.shards.values()],
+        )
+        return all(results)
+
+    async def warm_up(self):
+        self.started_at = time.time()
+        intervals = adaptive_intervals(1.0, 30.0)
+        while True:
+            self.attempts += 1
+            if await self._warm_once():
+                self.ready = True
+                self.finished_at = time.time()
+                print(f"Прогрев завершён за {self.finished_at - self.started_at:.1f} с")
+                return
+            failed = [name for name, step in self.steps.items() if not step["ok"]]
+            print(f"Прогрев не завершён, повтор: {', '.join(failed)}")
+            await asyncio.sleep(next(intervals))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "attempts": self.attempts,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "steps": self.steps,
+            "job_role": "leader" if job_manager.leader else "follower",
+        }
+
+
+readiness = Readiness()
+
+
+
+class RecipientCache:
+    """
+    TTL/LRU-кэш ответов searchStarsRecipient / searchPremiumGiftRecipient по нормализованному логину.
+    Найденные получатели живут ttl, отказы Fragment — отдельно и меньше (negative_ttl).
+    """
+
+    def __init__(self, max_size: int = RECIPIENT_CACHE_SIZE, ttl: float = RECIPIENT_CACHE_TTL,
+                 negative_ttl: float = RECIPIENT_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: OrderedDict[tuple, tuple] = OrderedDict()
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def normalize(login: str) -> str:
+        return login.strip().lstrip("@").lower()
+
+    def get(self, kind: str, login: str) -> tuple[bool, Dict[str, Any] | None]:
+        key = (kind, self.normalize(login))
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return False, None
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.stats["hits" if "found" in response else "negative_hits"] += 1
+        return True, response
+
+    def put(self, kind: str, login: str, response: Dict[str, Any]):
+        if "found" in response:
+            ttl = self.ttl
+        elif response.get("error"):
+            ttl = self.negative_ttl
         else:
-            return None
+            # Пустой ответ без ошибки скорее говорит о сбое сессии, чем об отсутствии логина
+            return
+        key = (kind, self.normalize(login))
+        self._entries[key] = (time.monotonic() + ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, kind: str, login: str):
+        self._entries.pop((kind, self.normalize(login)), None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        positive = sum(1 for _, response in self._entries.values() if "found" in response)
+        return {
+            "size": len(self._entries),
+            "positive": positive,
+            "negative": len(self._entries) - positive,
+            "max_size": self.max_size,
+            "stats": dict(self.stats),
+        }
 
-    return None
+
+recipient_cache = RecipientCache()
+
+
+async def search_recipient(client: FragmentClient, kind: str, login: str,
+                           data: Dict[str, Any]) -> Dict[str, Any]:
+    hit, cached = recipient_cache.get(kind, login)
+    if hit:
+        return cached
+    response = await client.call(data)
+    recipient_cache.put(kind, login, response)
+    return response
+
+
+async def prepare_stars_purchase(login: str, quantity: int, hide_sender: int,
+                                 results: Dict[str, Any]) -> Dict[str, Any] | None:
+    """
+    HTTP-шаги Fragment для покупки звёзд, до получения транзакции.
+    Ответы складываются в results; при неудаче возвращает None.
+    """
+    client = get_shard().fragment
+    async with client.semaphore:
+        while True:
+            state, refreshed = await client.ensure_state("stars")
+            results.update(state)
+
+            search_data = {"query": login, "quantity": str(quantity), "method": "searchStarsRecipient"}
+            search_resp = await search_recipient(client, "stars", login, search_data)
+            results["searchStarsRecipient"] = search_resp
+
+            if "found" not in search_resp:
+                return None
+
+            recipient = search_resp["found"]["recipient"]
+            buy_data = {"recipient": recipient, "quantity": str(quantity), "method": "initBuyStarsRequest"}
+            buy_resp = await client.call(buy_data)
+            results["initBuyStarsRequest"] = buy_resp
+            if buy_resp.get("req_id"):
+                break
+
+            # Устарело либо состояние покупки, либо закэшированный получатель: сбрасываем оба и пробуем ещё раз
+            recipient_cache.invalidate("stars", login)
+            client.invalidate("stars")
+            if refreshed:
+                return None
+        set_job_stage("fragment_request", req_id=buy_resp["req_id"])
+
+        link_data = {"account": json.dumps(""), "device": json.dumps(FRAGMENT_DEVICE), "transaction": "1",
+                     "id": buy_resp["req_id"], "show_sender": str(hide_sender), "method": "getBuyStarsLink"}
+        link_resp = await client.call(link_data)
+        results["getBuyStarsLink"] = link_resp
+
+        if not link_resp.get("ok") or "transaction" not in link_resp:
+            return None
+        return link_resp
 
 
 async def buy_stars_logic_internal(login: str, quantity: int, hide_sender: int = 0) -> Dict[str, Any]:
-    async with fragment_lock:
-        async with WalletManager(TONAPI_KEY, MNEMONIC) as wm:
-            results: Dict[str, Any] = {}
-            async with aiohttp.ClientSession(cookies=FRAGMENT_COOKIES, headers=FRAGMENT_HEADERS) as session:
-                init_data = {"mode": "new", "lv": "false", "dh": "1", "method": "updateStarsBuyState"}
-                async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=init_data) as resp:
-                    results["updateStarsBuyState"] = clean_and_filter(await resp.json())
-
-                search_data = {"query": login, "quantity": str(quantity), "method": "searchStarsRecipient"}
-                async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=search_data) as resp:
-                    search_resp = await resp.json()
-                results["searchStarsRecipient"] = clean_and_filter(search_resp)
-
-                if "found" not in search_resp:
-                    return results
-
-                price_data = {"stars": "", "quantity": str(quantity), "method": "updateStarsPrices"}
-                async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=price_data) as resp:
-                    results["updateStarsPrices"] = clean_and_filter(await resp.json())
-
-                recipient = search_resp["found"]["recipient"]
-                buy_data = {"recipient": recipient, "quantity": str(quantity), "method": "initBuyStarsRequest"}
-                async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=buy_data) as resp:
-                    buy_resp = await resp.json()
-                results["initBuyStarsRequest"] = clean_and_filter(buy_resp)
-
-                if not buy_resp.get("req_id"):
-                    return results
-
-                req_id = buy_resp["req_id"]
-                device = {"platform": "browser", "appName": "telegram-wallet", "appVersion": "1",
-                          "maxProtocolVersion": 2, "features": ["SendTransaction",
-                                                                {"name": "SendTransaction", "maxMessages": 4,
-                                                                 "extraCurrencySupported": True}]}
-                link_data = {"account": json.dumps(""), "device": json.dumps(device), "transaction": "1", "id": req_id,
-                             "show_sender": str(hide_sender), "method": "getBuyStarsLink"}
-                async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=link_data) as resp:
-                    link_resp = await resp.json()
-                results["getBuyStarsLink"] = clean_and_filter(link_resp)
-
-                if not link_resp.get("ok") or "transaction" not in link_resp:
-                    return results
-
-                transfers = []
-                for msg in link_resp["transaction"].get("messages", []):
-                    addr = msg["address"]
-                    amt = float(msg["amount"]) / 1e9
-                    payload = msg.get("payload", "")
-                    transfer_result = await wm.transfer(addr, amt, payload)
-                    transfers.append(transfer_result)
-
-                results["transfers"] = transfers
-                total_nano = sum(t["amount"] for t in transfers if t.get("amount") is not None)
-                results["total_ton"] = str(total_nano / 1e9)
-                results["tx_hash"] = transfers[0].get("tx_hash") if transfers else None
-
-            return results
+    results: Dict[str, Any] = {}
+    set_job_stage("fragment")
+    link_resp = await prepare_stars_purchase(login, quantity, hide_sender, results)
+    if link_resp is None:
+        return results
+
+    set_job_stage("wallet_transfer")
+    await send_stars_transfers(link_resp, results)
+    set_job_stage("sent", tx_hash=results["tx_hash"])
+
+    return results
+
+
+async def send_stars_transfers(link_resp: Dict[str, Any], results: Dict[str, Any]) -> List[Dict[str, Any]]:
+    wm = await get_wallet_manager()
+    messages = [
+        {"address": msg["address"], "amount": float(msg["amount"]) / 1e9, "payload": msg.get("payload", "")}
+        for msg in link_resp["transaction"].get("messages", [])
+    ]
+    transfers = await wm.transfer_batch(messages)
+
+    results["transfers"] = transfers
+    # amount уже в TON (пересчитан из нанотонов выше)
+    results["total_ton"] = str(sum(t["amount"] for t in transfers if t.get("amount") is not None))
+    results["tx_hash"] = transfers[0].get("tx_hash") if transfers else None
+    return transfers
+
+
+def _transfers_not_sent(transfers: List[Dict[str, Any]]) -> bool:
+    """Сообщения точно не попали в сеть, и покупку можно повторить без риска двойной оплаты."""
+    return not any(t.get("success") for t in transfers) and all(
+        t.get("tx_hash") is None or t.get("error") in ("seqno_expired", "seqno_gap") for t in transfers
+    )
 
 
 async def buy_stars_logic(login: str, quantity: int, hide_sender: int = 0, interval_seconds: int = 10,
-                          max_attempts: int = 360, max_send_attempts: int = 5) -> Dict[str, Any]:
-    if quantity <= 5000:
+                          max_attempts: int = 360, max_send_attempts: int = 5,
+                          progress: List[Dict[str, Any]] | None = None) -> Dict[str, Any]:
+    if quantity <= STAR_BATCH_SIZE_1:
         return await _send_stars_single_batch(login, quantity, hide_sender, interval_seconds, max_attempts,
                                               max_send_attempts)
     else:
         return await _send_stars_multiple_batches(login, quantity, hide_sender, interval_seconds, max_attempts,
-                                                  max_send_attempts)
+                                                  max_send_attempts, progress)
 
 
 async def _send_stars_single_batch(login: str, quantity: int, hide_sender: int = 0, interval_seconds: int = 10,
@@ -355,12 +1615,18 @@ async def _send_stars_single_batch(login: str, quantity: int, hide_sender: int =
     send_result = await buy_stars_logic_internal(login, quantity, hide_sender)
     results = send_result.copy()
 
-    if not send_result.get("transfers"):
+    transfers = send_result.get("transfers")
+    if not transfers:
+        return results
+    if _transfers_not_sent(transfers) or not send_result.get("tx_hash"):
+        # Подтверждать нечего: сообщение не ушло в сеть
+        results["status"] = "failed"
+        results["error"] = next((t.get("error") for t in transfers if t.get("error")), "transfer_failed")
         return results
 
     event_id = send_result["tx_hash"]
-    transaction_result = await check_transaction_periodically(event_id, login, quantity, interval_seconds, max_attempts,
-                                                              max_send_attempts)
+    set_job_stage("confirming", tx_hash=event_id)
+    transaction_result = await check_transaction_periodically(event_id, interval_seconds, max_attempts)
 
     results["transaction_status"] = transaction_result
     if transaction_result:
@@ -371,202 +1637,1283 @@ async def _send_stars_single_batch(login: str, quantity: int, hide_sender: int =
     return results
 
 
-async def _send_stars_multiple_batches(login: str, quantity: int, hide_sender: int = 0, interval_seconds: int = 10,
-                                       max_attempts: int = 360, max_send_attempts: int = 5) -> Dict[str, Any]:
-    BATCH_SIZE_1 = 5000
-    BATCH_SIZE_2 = 5050
+def plan_star_batches(quantity: int) -> List[int]:
     batches = []
     remaining = quantity
     while remaining > 0:
-        if remaining < 5050:
-            batch_size = min(BATCH_SIZE_2, remaining)
+        if remaining < STAR_BATCH_SIZE_2:
+            batch_size = min(STAR_BATCH_SIZE_2, remaining)
         else:
-            batch_size = min(BATCH_SIZE_1, remaining)
+            batch_size = min(STAR_BATCH_SIZE_1, remaining)
         batches.append(batch_size)
         remaining -= batch_size
+    return batches
 
-    all_results = []
-    all_transfers = []
-    total_ton_sent = 0
-
-    for i, batch_quantity in enumerate(batches):
-        batch_num = i + 1
-        total_batches = len(batches)
-
-        batch_result = await buy_stars_logic_internal(login, batch_quantity, hide_sender)
 
-        if batch_result.get("transfers"):
-            all_transfers.extend(batch_result["transfers"])
-            total_ton_sent += float(batch_result.get("total_ton", 0))
+async def _run_star_batch(entry: Dict[str, Any], batch_result: Dict[str, Any], login: str, hide_sender: int,
+                          interval_seconds: int, max_attempts: int, max_send_attempts: int, sent: asyncio.Event):
+    """
+    Одна партия многопартийного заказа: Fragment -> кошелёк -> подтверждение.
+    sent выставляется, как только партия ушла в сеть (или окончательно не смогла уйти),
+    чтобы следующая партия начала готовиться на Fragment, пока эта подтверждается.
+    """
+    label = f"batch_{entry['batch_number']}_of_{entry['total_batches']}"
+    try:
+        while entry["attempts"] < max_send_attempts:
+            entry["attempts"] += 1
+            batch_result.clear()
+            entry["status"] = "preparing"
+            set_job_stage(f"{label}_fragment")
+            link_resp = await prepare_stars_purchase(login, entry["quantity"], hide_sender, batch_result)
+            if link_resp is None:
+                entry["error"] = "fragment_prepare_failed"
+                await asyncio.sleep(entry["attempts"])
+                continue
+
+            entry["status"] = "sending"
+            set_job_stage(f"{label}_wallet_transfer")
+            # Задача партии работает в своём контексте, так что хук видят только её подписи
+            on_signed.set(lambda msg_hash, raw_hash: entry.update(tx_hash=msg_hash, raw_hash=raw_hash))
+            transfers = await send_stars_transfers(link_resp, batch_result)
+            entry["tx_hash"] = batch_result.get("tx_hash")
+            if _transfers_not_sent(transfers):
+                # Сообщение точно не попало в сеть: следующая попытка и восстановление могут покупать заново
+                entry["tx_hash"] = entry["raw_hash"] = None
+                entry["error"] = next((t.get("error") for t in transfers if t.get("error")), "transfer_failed")
+                continue
+            sent.set()
+
+            entry["status"] = "confirming"
+            set_job_stage(f"{label}_confirming", tx_hash=entry["tx_hash"])
+            transaction_result = await check_transaction_periodically(entry["tx_hash"], interval_seconds, max_attempts)
+            batch_result["transaction_status"] = transaction_result
+            if transaction_result is None:
+                # Транзакция могла пройти: повторная покупка здесь рискует двойной оплатой
+                entry["status"] = "unconfirmed"
+                entry["error"] = "unconfirmed"
+                return
+            status = transaction_result.get("actions", [{}])[0].get("status", "unknown")
+            if status == "ok":
+                entry["status"] = "ok"
+                entry["error"] = None
+                return
+            entry["error"] = f"transaction_{status}"
+        entry["status"] = "failed"
+    except Exception as e:
+        entry["status"] = "failed"
+        entry["error"] = str(e)
+    finally:
+        batch_result["status"] = entry["status"]
+        set_job_stage(f"{label}_{entry['status']}")
+        sent.set()
+
+
+async def _reconcile_progress(progress: List[Dict[str, Any]]):
+    """
+    После перезапуска: партии, которые успели уйти в сеть, не покупаются заново,
+    а сверяются по tx_hash. Неподтверждённые остаются unconfirmed для ручной проверки.
+    """
+    for entry in progress:
+        if entry["status"] in ("ok", "pending"):
+            continue
+        if not entry.get("tx_hash"):
+            if entry["status"] in ("sending", "confirming"):
+                # Упали между подписью и записью хэша: сообщение могло уйти, покупать заново нельзя
+                entry["status"], entry["error"] = "unconfirmed", "unconfirmed_after_restart"
+            continue
+        tx_result = await get_shard().watcher.wait(entry["tx_hash"], timeout=JOB_RECOVERY_CONFIRM_TIMEOUT,
+                                                   raw_hash=entry.get("raw_hash"))
+        status = (tx_result or {}).get("actions", [{}])[0].get("status")
+        if status == "ok":
+            entry["status"], entry["error"] = "ok", None
+        elif status == "failed":
+            entry["status"], entry["error"] = "failed", "transaction_failed"
+        else:
+            entry["status"], entry["error"] = "unconfirmed", "unconfirmed_after_restart"
 
-            if batch_result.get("tx_hash"):
-                event_id = batch_result["tx_hash"]
-                transaction_result = await check_transaction_periodically(
-                    event_id, login, batch_quantity, interval_seconds, max_attempts, max_send_attempts
-                )
 
-                batch_result["transaction_status"] = transaction_result
-                if transaction_result:
-                    batch_result["status"] = transaction_result.get("actions", [{}])[0].get("status", "unknown")
-                else:
-                    batch_result["status"] = "failed"
-            else:
-                batch_result["status"] = "failed"
-        else:
-            batch_result["status"] = "failed"
+async def _send_stars_multiple_batches(login: str, quantity: int, hide_sender: int = 0, interval_seconds: int = 10,
+                                       max_attempts: int = 360, max_send_attempts: int = 5,
+                                       progress: List[Dict[str, Any]] | None = None) -> Dict[str, Any]:
+    batches = plan_star_batches(quantity)
+    if progress is None or [p["quantity"] for p in progress] != batches:
+        progress = [{
+            "batch_number": i + 1,
+            "total_batches": len(batches),
+            "quantity": batch_quantity,
+            "status": "pending",
+            "attempts": 0,
+            "tx_hash": None,
+            "raw_hash": None,
+            "error": None,
+        } for i, batch_quantity in enumerate(batches)]
+    set_job_stage("batches", progress=progress)
+
+    all_results: List[Dict[str, Any]] = [{} for _ in progress]
+    tasks = []
+    for entry, batch_result in zip(progress, all_results):
+        # Подтверждённые и, возможно, прошедшие партии при возобновлении не повторяем
+        if entry["status"] in ("ok", "unconfirmed"):
+            continue
+        entry["attempts"] = 0
+        sent = asyncio.Event()
+        tasks.append(asyncio.create_task(_run_star_batch(
+            entry, batch_result, login, hide_sender, interval_seconds, max_attempts, max_send_attempts, sent
+        )))
+        await sent.wait()
+    await asyncio.gather(*tasks)
 
+    all_transfers = []
+    total_ton_sent = 0.0
+    for entry, batch_result in zip(progress, all_results):
+        batch_result.setdefault("status", entry["status"])
+        if entry["tx_hash"]:
+            batch_result.setdefault("tx_hash", entry["tx_hash"])
         batch_result["batch_info"] = {
-            "batch_number": batch_num,
-            "total_batches": total_batches,
-            "batch_quantity": batch_quantity
+            "batch_number": entry["batch_number"],
+            "total_batches": entry["total_batches"],
+            "batch_quantity": entry["quantity"],
+            "attempts": entry["attempts"],
+            "error": entry["error"],
         }
-
-        all_results.append(batch_result)
-
-        if i < len(batches) - 1:
-            await asyncio.sleep(2)
+        all_transfers.extend(batch_result.get("transfers", []))
+        total_ton_sent += float(batch_result.get("total_ton", 0) or 0)
 
     final_result = {
-        "status": "ok" if all(r.get("status") == "ok" for r in all_results) else "failed",
+        "status": "ok" if all(entry["status"] == "ok" for entry in progress) else "failed",
         "transfers": all_transfers,
         "total_ton": str(total_ton_sent),
         "batches": all_results,
+        "progress": progress,
+        "failed_batches": [entry["batch_number"] for entry in progress if entry["status"] != "ok"],
         "total_quantity": quantity,
         "total_batches": len(batches),
-        "batch_size": BATCH_SIZE_1
+        "batch_size": STAR_BATCH_SIZE_1
     }
+    failed = [entry for entry in progress if entry["status"] != "ok"]
+    if failed:
+        final_result["error"] = failed[0]["error"] or f"batch_{failed[0]['batch_number']}_{failed[0]['status']}"
 
-    if all_results and all_results[0].get("tx_hash"):
-        final_result["tx_hash"] = all_results[0]["tx_hash"]
+    first_hash = next((entry["tx_hash"] for entry in progress if entry["tx_hash"]), None)
+    if first_hash:
+        final_result["tx_hash"] = first_hash
 
     return final_result
 
 
 async def check_transaction_simple(event_id: str, interval_seconds: int = 10, max_attempts: int = 360) -> Dict[str, Any] | None:
-    attempt = 0
-    while attempt < max_attempts:
-        result = await get_event(event_id)
-        if result is not None:
-            if "actions" in result and len(result["actions"]) > 0:
-                action = result["actions"][0]
-                if action.get("status") in ("ok", "failed"):
-                    return result
-            elif "error" in result and result["error"] == "entity not found":
-                # keep polling without resending
-                pass
-        attempt += 1
-        await asyncio.sleep(interval_seconds)
-    return None
+    return await get_shard().watcher.wait(event_id, timeout=interval_seconds * max_attempts)
+
+
+async def prepare_premium_purchase(login: str, months: int, hide_sender: int,
+                                   results: Dict[str, Any]) -> Dict[str, Any] | None:
+    client = get_shard().fragment
+    async with client.semaphore:
+        while True:
+            state, refreshed = await client.ensure_state("premium")
+            results.update(state)
+
+            search_data = {"query": login, "method": "searchPremiumGiftRecipient"}
+            search_resp = await search_recipient(client, "premium", login, search_data)
+            results["searchPremiumGiftRecipient"] = search_resp
+            recipient = search_resp.get("found", {}).get("recipient")
+            if not recipient:
+                return None
+
+            init_data = {"recipient": recipient, "months": str(months), "method": "initGiftPremiumRequest"}
+            init_resp = await client.call(init_data)
+            results["initGiftPremiumRequest"] = init_resp
+            req_id = init_resp.get("req_id")
+            if req_id:
+                break
+
+            recipient_cache.invalidate("premium", login)
+            client.invalidate("premium")
+            if refreshed:
+                return None
+        set_job_stage("fragment_request", req_id=req_id)
+
+        link_req = {"account": json.dumps(""), "device": json.dumps(FRAGMENT_DEVICE), "transaction": "1", "id": req_id,
+                    "show_sender": str(hide_sender), "method": "getGiftPremiumLink"}
+        link_resp = await client.call(link_req)
+        results["getGiftPremiumLink"] = link_resp
+
+        if not link_resp.get("ok") or "transaction" not in link_resp:
+            return None
+        return link_resp
 
 
 async def buy_premium_logic(login: str, months: int, hide_sender: int = 0) -> Dict[str, Any]:
     if months not in (3, 6, 12):
         return {"error": "invalid_months", "allowed": [3, 6, 12]}
-    async with fragment_lock:
-        async with WalletManager(TONAPI_KEY, MNEMONIC) as wm:
-            results: Dict[str, Any] = {}
-            async with aiohttp.ClientSession(cookies=FRAGMENT_COOKIES, headers=FRAGMENT_HEADERS) as session:
-                steps = [
-                    ("updatePremiumState", {"mode": "new", "lv": "false", "dh": "1", "method": "updatePremiumState"}),
-                    ("searchPremiumGiftRecipient", {"query": login, "method": "searchPremiumGiftRecipient"}),
-                    ("initGiftPremiumRequest", {"recipient": None, "months": str(months), "method": "initGiftPremiumRequest"}),
-                ]
-                for name, data in steps:
-                    if name == "initGiftPremiumRequest":
-                        recipient = results.get("searchPremiumGiftRecipient", {}).get("found", {}).get("recipient")
-                        if not recipient:
-                            break
-                        data["recipient"] = recipient
-                    async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=data) as resp:
-                        raw = await resp.json()
-                    results[name] = clean_and_filter(raw)
-                    if name == "searchPremiumGiftRecipient" and "found" not in raw:
-                        return clean_and_filter(results)
-                    if name == "initGiftPremiumRequest" and not raw.get("req_id"):
-                        return clean_and_filter(results)
-
-                req_id = results.get("initGiftPremiumRequest", {}).get("req_id")
-                if not req_id:
-                    return results
-
-                device = {"platform": "browser", "appName": "telegram-wallet", "appVersion": "1",
-                          "maxProtocolVersion": 2, "features": ["SendTransaction",
-                                                                    {"name": "SendTransaction", "maxMessages": 4,
-                                                                     "extraCurrencySupported": True}]}
-                link_req = {"account": json.dumps(""), "device": json.dumps(device), "transaction": "1", "id": req_id,
-                            "show_sender": str(hide_sender), "method": "getGiftPremiumLink"}
-                async with session.post(f"https://fragment.com/api?hash={FRAGMENT_HASH}", data=link_req) as resp4:
-                    link_resp = await resp4.json()
-                results["getGiftPremiumLink"] = clean_and_filter(link_resp)
-
-                if not link_resp.get("ok") or "transaction" not in link_resp:
-                    return clean_and_filter(results)
-
-                transfers = []
-                for msg in link_resp["transaction"].get("messages", []):
-                    addr = msg["address"]
-                    amt = float(msg["amount"]) / 1e9
-                    raw_payload = msg.get("payload", "")
-                    decoded_comment = decode_payload_b64_premium(raw_payload)
-                    transfer_result = await wm.transfer(addr, amt, decoded_comment)
-                    transfer_result["decoded_payload_preview"] = decoded_comment[:200]
-                    transfers.append(transfer_result)
-
-                results["transfers"] = transfers
-                total_nano = sum(t.get("amount", 0) for t in transfers)
-                results["total_ton"] = str(total_nano / 1e9)
-                results["tx_hash"] = transfers[0].get("tx_hash") if transfers else None
-
-                if results.get("tx_hash"):
-                    tx_result = await check_transaction_simple(results["tx_hash"])
-                    results["transaction_status"] = tx_result
-                    if tx_result:
-                        results["status"] = tx_result.get("actions", [{}])[0].get("status", "unknown")
-                    else:
-                        results["status"] = "failed"
-
-            return clean_and_filter(results)
+    results: Dict[str, Any] = {}
+    set_job_stage("fragment")
+    link_resp = await prepare_premium_purchase(login, months, hide_sender, results)
+    if link_resp is None:
+        return results
+
+    wm = await get_wallet_manager()
+    set_job_stage("wallet_transfer")
+    messages = [
+        {"address": msg["address"], "amount": float(msg["amount"]) / 1e9,
+         "payload": decode_payload_b64_premium(msg.get("payload", ""))}
+        for msg in link_resp["transaction"].get("messages", [])
+    ]
+    transfers = await wm.transfer_batch(messages)
+    for msg, transfer_result in zip(messages, transfers):
+        transfer_result["decoded_payload_preview"] = msg["payload"][:200]
+
+    results["transfers"] = transfers
+    results["total_ton"] = str(sum(t.get("amount", 0) for t in transfers))
+    results["tx_hash"] = transfers[0].get("tx_hash") if transfers else None
+
+    # Ожидание подтверждения не держит никаких блокировок
+    if results.get("tx_hash"):
+        set_job_stage("confirming", tx_hash=results["tx_hash"])
+        tx_result = await check_transaction_simple(results["tx_hash"])
+        results["transaction_status"] = tx_result
+        if tx_result:
+            results["status"] = tx_result.get("actions", [{}])[0].get("status", "unknown")
+        else:
+            results["status"] = "failed"
+
+    return results
+
+
+def _pack_groups(entries: List[Dict[str, Any]], max_messages: int = WALLET_MAX_MESSAGES) -> List[List[Dict[str, Any]]]:
+    """
+    Раскладывает заказы по внешним сообщениям кошелька (до max_messages сообщений в каждом),
+    не разрывая сообщения одного заказа между разными seqno.
+    """
+    groups: List[List[Dict[str, Any]]] = []
+    sizes: List[int] = []
+    for entry in sorted(entries, key=lambda e: len(e["messages"]), reverse=True):
+        size = len(entry["messages"])
+        for i, used in enumerate(sizes):
+            if used + size <= max_messages:
+                groups[i].append(entry)
+                sizes[i] += size
+                break
+        else:
+            groups.append([entry])
+            sizes.append(size)
+    return groups
+
+
+def _record_group_hash(group: List[Dict[str, Any]], msg_hash: str, raw_hash: str):
+    for packed in group:
+        packed["entry"].update(tx_hash=msg_hash, raw_hash=raw_hash)
+
+
+async def _send_batch_group(wm: WalletManager, group: List[Dict[str, Any]]):
+    messages = [msg for entry in group for msg in entry["messages"]]
+    # Хэш попадает в progress всех позиций группы ещё до отправки: после падения они сверяются, а не покупаются
+    on_signed.set(lambda msg_hash, raw_hash: _record_group_hash(group, msg_hash, raw_hash))
+    transfers = await wm.transfer_batch(messages)
+    offset = 0
+    for entry in group:
+        count = len(entry["messages"])
+        entry["transfers"] = transfers[offset:offset + count]
+        offset += count
+
+
+async def _run_batch_round(todo: List[Dict[str, Any]], outputs: List[Dict[str, Any]]):
+    """Один проход по незавершённым позициям пакета: Fragment -> общие отправки -> подтверждения."""
+    for entry in todo:
+        entry["attempts"] += 1
+        entry["status"] = "preparing"
+        outputs[entry["item"]].clear()
+    set_job_stage("batch_fragment")
+    # Параллелизм HTTP-шагов ограничен семафором сессии Fragment шарда
+    link_resps = await asyncio.gather(*[
+        prepare_stars_purchase(entry["login"], entry["quantity"], entry["hide_sender"], outputs[entry["item"]])
+        for entry in todo
+    ], return_exceptions=True)
+
+    ready = []
+    for entry, link_resp in zip(todo, link_resps):
+        if isinstance(link_resp, Exception) or link_resp is None:
+            entry["status"] = "retry"
+            entry["error"] = str(link_resp) if isinstance(link_resp, Exception) else "fragment_prepare_failed"
+            continue
+        entry["status"] = "sending"
+        ready.append({"entry": entry, "messages": [
+            {"address": msg["address"], "amount": float(msg["amount"]) / 1e9, "payload": msg.get("payload", "")}
+            for msg in link_resp["transaction"].get("messages", [])
+        ]})
+    if not ready:
+        return
+
+    set_job_stage("batch_wallet_transfer")
+    wm = await get_wallet_manager()
+    await asyncio.gather(*[_send_batch_group(wm, group) for group in _pack_groups(ready)])
+
+    confirming = []
+    for packed in ready:
+        entry, transfers = packed["entry"], packed["transfers"]
+        output = outputs[entry["item"]]
+        output["transfers"] = transfers
+        output["total_ton"] = str(sum(t["amount"] for t in transfers if t.get("amount") is not None))
+        output["tx_hash"] = entry["tx_hash"] = transfers[0].get("tx_hash") if transfers else None
+        if _transfers_not_sent(transfers):
+            entry["tx_hash"] = entry["raw_hash"] = None
+            entry["status"] = "retry"
+            entry["error"] = next((t.get("error") for t in transfers if t.get("error")), "transfer_failed")
+            continue
+        entry["status"] = "confirming"
+        confirming.append(entry)
+    set_job_stage("batch_confirming")
+
+    # Позиции из одного внешнего сообщения ждут один и тот же хэш: наблюдатель склеит ожидания
+    tx_results = await asyncio.gather(*[check_transaction_simple(entry["tx_hash"]) for entry in confirming])
+    for entry, tx_result in zip(confirming, tx_results):
+        outputs[entry["item"]]["transaction_status"] = tx_result
+        if tx_result is None:
+            # Могла пройти: повторять нельзя
+            entry["status"], entry["error"] = "unconfirmed", "unconfirmed"
+            continue
+        status = tx_result.get("actions", [{}])[0].get("status", "unknown")
+        if status == "ok":
+            entry["status"], entry["error"] = "ok", None
+        else:
+            entry["status"], entry["error"] = "retry", f"transaction_{status}"
+
+
+async def buy_stars_batch_logic(items: List[Dict[str, Any]],
+                                progress: List[Dict[str, Any]] | None = None) -> Dict[str, Any]:
+    """
+    Пакет мелких заказов звёзд одним заданием: Fragment-шаги всех позиций идут параллельно,
+    а их транзакции упаковываются по WALLET_MAX_MESSAGES в одно внешнее сообщение кошелька.
+    """
+    if progress is None or len(progress) != len(items):
+        progress = [{
+            "item": i,
+            "login": item["login"],
+            "quantity": item["quantity"],
+            "hide_sender": item.get("hide_sender", 0),
+            "order_id": item.get("order_id"),
+            "status": "pending",
+            "attempts": 0,
+            "tx_hash": None,
+            "raw_hash": None,
+            "error": None,
+        } for i, item in enumerate(items)]
+    for entry in progress:
+        entry["attempts"] = 0
+    set_job_stage("batch", progress=progress)
+
+    outputs: List[Dict[str, Any]] = [{} for _ in progress]
+    for _ in range(BUY_BATCH_MAX_ROUNDS):
+        todo = [entry for entry in progress if entry["status"] not in ("ok", "unconfirmed")]
+        if not todo:
+            break
+        await _run_batch_round(todo, outputs)
+        set_job_stage("batch_round_done", progress=progress)
+    for entry in progress:
+        if entry["status"] not in ("ok", "unconfirmed"):
+            entry["status"] = "failed"
+
+    results = []
+    for entry, output in zip(progress, outputs):
+        output.update({key: entry[key] for key in ("item", "login", "quantity", "order_id", "status", "error")})
+        if entry["tx_hash"]:
+            output.setdefault("tx_hash", entry["tx_hash"])
+        results.append(output)
+    failed = [entry["item"] for entry in progress if entry["status"] != "ok"]
+    final_result = {
+        "status": "ok" if not failed else "failed",
+        "items": results,
+        "progress": progress,
+        "failed_items": failed,
+        "total_ton": str(sum(float(output.get("total_ton", 0) or 0) for output in outputs)),
+    }
+    if failed:
+        final_result["error"] = f"{len(failed)} of {len(progress)} items failed"
+    first_hash = next((entry["tx_hash"] for entry in progress if entry["tx_hash"]), None)
+    if first_hash:
+        final_result["tx_hash"] = first_hash
+    return final_result
+
+
+# --- Фоновые задания (jobs) ---
+current_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("current_job", default=None)
+# Получает хэш подписанного сообщения и хэш его ячейки до отправки в сеть: партии записывают их в свою
+# запись progress, и set_job_stage("signed") сохраняет их в журнал вместе с ней
+on_signed: contextvars.ContextVar[Optional[Callable[[str, str], None]]] = contextvars.ContextVar(
+    "on_signed", default=None)
+
+JOB_TERMINAL_STATUSES = ("done", "failed")
+JOB_ACTIVE_STATUSES = ("queued", "running", "interrupted")
+
+
+def set_job_stage(stage: str, **fields) -> None:
+    job = current_job.get()
+    if job is None:
+        return
+    job.stage = stage
+    job.updated_at = time.time()
+    job.stage_log.append((stage, job.updated_at))
+    for key, value in fields.items():
+        if value is not None:
+            setattr(job, key, value)
+    job_store.save(job, stage_changed=True)
+    job_notifier.publish(job)
+
+
+class JobStore:
+    """
+    Журнал заданий в SQLite (WAL). Каждая смена стадии пишется сразу,
+    чтобы после перезапуска можно было продолжить или сверить незавершённые покупки.
+    """
+
+    def save(self, job: "Job", stage_changed: bool = False, strict: bool = False):
+        """strict: ошибку записи пробрасываем — для приёма задания, где журнал единственная его копия."""
+        db = JobsSessionLocal()
+        try:
+            row = db.get(FulfillmentJob, job.id) or FulfillmentJob(id=job.id)
+            row.kind = job.kind
+            row.idempotency_key = job.key
+            row.params = json.dumps(job.params)
+            row.status = job.status
+            row.stage = job.stage
+            row.req_id = job.req_id
+            row.tx_hash = job.tx_hash
+            row.raw_hash = job.raw_hash
+            row.seqno = job.seqno
+            row.shard = job.shard
+            row.progress = json.dumps(job.progress) if job.progress is not None else None
+            row.result = json.dumps(job.result, default=str) if job.result is not None else None
+            row.error = job.error
+            row.created_at = job.created_at
+            row.updated_at = job.updated_at
+            row.started_at = job.started_at
+            row.finished_at = job.finished_at
+            db.add(row)
+            if stage_changed:
+                db.add(FulfillmentJobStage(job_id=job.id, stage=job.stage, tx_hash=job.tx_hash, at=job.updated_at))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if strict:
+                raise
+            print(f"Не удалось сохранить задание {job.id}: {e}")
+        finally:
+            db.close()
+
+    def _load(self, query) -> List["Job"]:
+        db = JobsSessionLocal()
+        try:
+            return [Job.from_row(row) for row in query(db)]
+        finally:
+            db.close()
+
+    def get(self, job_id: str) -> Optional["Job"]:
+        jobs = self._load(lambda db: db.query(FulfillmentJob).filter(FulfillmentJob.id == job_id).all())
+        return jobs[0] if jobs else None
+
+    def get_by_key(self, key: str) -> Optional["Job"]:
+        jobs = self._load(lambda db: db.query(FulfillmentJob).filter(FulfillmentJob.idempotency_key == key).all())
+        return jobs[0] if jobs else None
+
+    def unfinished(self) -> List["Job"]:
+        return self._load(lambda db: db.query(FulfillmentJob)
+                          .filter(FulfillmentJob.status.in_(JOB_ACTIVE_STATUSES))
+                          .order_by(FulfillmentJob.created_at).all())
+
+    def queued(self) -> List["Job"]:
+        return self._load(lambda db: db.query(FulfillmentJob)
+                          .filter(FulfillmentJob.status == "queued")
+                          .order_by(FulfillmentJob.created_at).all())
+
+    def count(self, status: str) -> int:
+        db = JobsSessionLocal()
+        try:
+            return db.query(FulfillmentJob).filter(FulfillmentJob.status == status).count()
+        finally:
+            db.close()
+
+    def recent(self, status: str | None = None, limit: int = 100) -> List["Job"]:
+        def query(db):
+            q = db.query(FulfillmentJob)
+            if status is not None:
+                q = q.filter(FulfillmentJob.status == status)
+            return q.order_by(FulfillmentJob.created_at.desc()).limit(limit).all()
+        return self._load(query)
+
+
+job_store = JobStore()
+
+
+class Job:
+    def __init__(self, kind: str, params: Dict[str, Any], key: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.key = key
+        self.status = "queued"
+        self.stage = "queued"
+        self.tx_hash: str | None = None
+        self.raw_hash: str | None = None
+        self.result: Dict[str, Any] | None = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.progress: List[Dict[str, Any]] | None = None
+        self.req_id: str | None = None
+        self.seqno: int | None = None
+        self.shard: str | None = None
+        self.stage_log: List[tuple[str, float]] = []
+
+    @classmethod
+    def from_row(cls, row: FulfillmentJob) -> "Job":
+        job = cls(row.kind, json.loads(row.params), row.idempotency_key)
+        job.id = row.id
+        job.status = row.status
+        job.stage = row.stage
+        job.req_id = row.req_id
+        job.tx_hash = row.tx_hash
+        job.raw_hash = row.raw_hash
+        job.seqno = row.seqno
+        job.shard = row.shard
+        job.progress = json.loads(row.progress) if row.progress else None
+        job.result = json.loads(row.result) if row.result else None
+        job.error = row.error
+        job.created_at = row.created_at
+        job.updated_at = row.updated_at
+        job.started_at = row.started_at
+        job.finished_at = row.finished_at
+        return job
+
+    @property
+    def finished(self) -> bool:
+        return self.status in JOB_TERMINAL_STATUSES
+
+    def timings(self) -> Dict[str, Any]:
+        """Длительности в секундах: ожидание в очереди, выполнение и стадии текущего запуска."""
+        stages: Dict[str, float] = {}
+        end = self.finished_at or time.time()
+        for (stage, at), (_, next_at) in zip(self.stage_log, self.stage_log[1:] + [("", end)]):
+            stages[stage] = round(stages.get(stage, 0.0) + next_at - at, 3)
+        return {
+            "queued": round((self.started_at or end) - self.created_at, 3),
+            "running": round(end - (self.started_at or end), 3),
+            "stages": stages,
+        }
+
+    def to_dict(self, with_result: bool = True) -> Dict[str, Any]:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "stage": self.stage,
+            "req_id": self.req_id,
+            "tx_hash": self.tx_hash,
+            "seqno": self.seqno,
+            "shard": self.shard,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress,
+        }
+        if with_result:
+            data["result"] = self.result
+        return data
+
+
+async def _run_stars_job(job: Job) -> Dict[str, Any]:
+    params = job.params
+    return await buy_stars_logic(params["login"], params["quantity"], params.get("hide_sender", 0),
+                                 progress=job.progress)
+
+
+async def _run_premium_job(job: Job) -> Dict[str, Any]:
+    params = job.params
+    return await buy_premium_logic(params["login"], params["months"], params.get("hide_sender", 0))
+
+
+async def _run_stars_batch_job(job: Job) -> Dict[str, Any]:
+    return await buy_stars_batch_logic(job.params["items"], progress=job.progress)
+
+
+async def _run_reconcile_job(job: Job) -> Dict[str, Any]:
+    """Сверка покупки, подписанной до перезапуска: только ждём подтверждения, ничего не отправляем."""
+    set_job_stage("reconciling", tx_hash=job.tx_hash)
+    tx_result = await get_shard().watcher.wait(job.tx_hash, timeout=JOB_RECOVERY_CONFIRM_TIMEOUT,
+                                               raw_hash=job.raw_hash)
+    result: Dict[str, Any] = {"tx_hash": job.tx_hash, "transaction_status": tx_result, "recovered": True}
+    if tx_result:
+        result["status"] = tx_result.get("actions", [{}])[0].get("status", "unknown")
+    else:
+        result["status"] = "failed"
+        result["error"] = "unconfirmed_after_restart"
+    return result
+
+
+async def _run_recovered_batches_job(job: Job) -> Dict[str, Any]:
+    # Многопартийный заказ: подтверждённые партии пропустятся, отправленные сверятся
+    set_job_stage("reconciling")
+    await _reconcile_progress(job.progress)
+    return await JOB_HANDLERS[job.kind](job)
+
+
+JOB_HANDLERS = {
+    "stars": _run_stars_job,
+    "premium": _run_premium_job,
+    "stars_batch": _run_stars_batch_job,
+}
+
+
+COMPACT_RESULT_KEYS = ("progress", "failed_batches", "failed_items", "total_quantity", "total_batches", "recovered")
+COMPACT_TRANSFER_KEYS = ("address", "amount", "success", "tx_hash", "seqno", "error", "attempts")
+
+
+def _fragment_error(result: Dict[str, Any]) -> str | None:
+    """Первая ошибка из ответов Fragment — почему заказ не дошёл до кошелька."""
+    for name, response in result.items():
+        if isinstance(response, dict) and isinstance(response.get("error"), str):
+            return f"{name}: {strip_html_tags(response['error'])}"
+    return None
+
+
+def compact_result(result: Dict[str, Any] | None) -> Dict[str, Any] | None:
+    """
+    Краткий результат задания: статус, хэши, суммы. Полные ответы Fragment и тела событий
+    остаются только в verbose-режиме (trace).
+    """
+    if result is None:
+        return None
+    transfers = result.get("transfers") or []
+    tx_hashes = list(dict.fromkeys(t["tx_hash"] for t in transfers if t.get("tx_hash")))
+    compact = {
+        "status": result.get("status"),
+        "error": result.get("error") or (None if transfers else _fragment_error(result)),
+        "tx_hash": result.get("tx_hash"),
+        "tx_hashes": tx_hashes,
+        "total_ton": result.get("total_ton"),
+        "transfers": [{key: t.get(key) for key in COMPACT_TRANSFER_KEYS} for t in transfers],
+    }
+    event = result.get("transaction_status")
+    if isinstance(event, dict):
+        compact["event_id"] = event.get("event_id")
+    for key in COMPACT_RESULT_KEYS:
+        if key in result:
+            compact[key] = result[key]
+    return compact
+
+
+def _spent_ton(result: Dict[str, Any] | None) -> float:
+    try:
+        return float((result or {}).get("total_ton") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ProcessLock:
+    """
+    Эксклюзивная блокировка файла между процессами (flock / msvcrt.locking).
+    ОС снимает её сама, если процесс-владелец умер.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: int | None = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+wallet_lock = ProcessLock(WALLET_LOCK_FILE)
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("job queue is full")
+        self.retry_after = retry_after
+
+
+class JobManager:
+    """
+    Очередь и воркеры заданий. При нескольких процессах (uvicorn --workers, несколько экземпляров)
+    воркеры работают только в ведущем — владельце wallet_lock, так что seqno каждого кошелька
+    двигает один процесс. Остальные пишут задания в журнал, откуда ведущий их забирает.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, ttl_seconds: int = JOB_TTL_SECONDS,
+                 max_queue: int = JOB_MAX_QUEUE):
+        self.workers = max(1, workers)
+        self.ttl_seconds = ttl_seconds
+        self.max_queue = max_queue
+        # EWMA времени выполнения задания, для оценки Retry-After
+        self.service_time: float | None = None
+        self.stats = {"accepted": 0, "rejected": 0}
+        self.leader = False
+        self.jobs: Dict[str, Job] = {}
+        self._by_key: Dict[str, str] = {}
+        self._queue: asyncio.Queue | None = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        if wallet_lock.try_acquire():
+            await self._become_leader()
+        else:
+            print("Кошельком владеет другой процесс: принимаю заказы, выполняет их ведущий")
+            self._tasks.append(asyncio.create_task(self._follow()))
+
+    async def _become_leader(self):
+        self.leader = True
+        self._tasks += [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._claim_loop()))
+        await self.recover()
+
+    async def _follow(self):
+        # Ведущий мог упасть: тогда ОС снимет блокировку и его задания продолжит этот процесс
+        while True:
+            await asyncio.sleep(JOB_LEADER_RETRY)
+            if wallet_lock.try_acquire():
+                print("Блокировка кошелька освободилась, процесс становится ведущим")
+                await self._become_leader()
+                return
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Невыполненные задания остаются в журнале как queued и подхватятся recover()
+        self._queue = None
+        self.leader = False
+        wallet_lock.release()
+
+    async def recover(self):
+        """Возобновляет или сверяет задания, не завершённые до перезапуска."""
+        for job in job_store.unfinished():
+            if job.id not in self.jobs:
+                self._adopt(job, recovered=True)
+
+    async def _claim_loop(self):
+        """Забирает задания, записанные в журнал другими процессами."""
+        while True:
+            await asyncio.sleep(JOB_CLAIM_INTERVAL)
+            try:
+                for job in job_store.queued():
+                    if job.id not in self.jobs:
+                        self._adopt(job, recovered=False)
+            except Exception as e:
+                print(f"Ошибка чтения очереди заданий: {e}")
+
+    def _adopt(self, job: Job, recovered: bool):
+        handler = None
+        if job.progress:
+            handler = _run_recovered_batches_job
+        elif job.tx_hash:
+            handler = _run_reconcile_job
+        else:
+            # Ещё ничего не отправлено: резервируем средства как для нового заказа
+            balance_ledger.reserve(job.id, balance_ledger.estimate(job.kind, job.params))
+        if recovered:
+            print(f"Восстанавливаю задание {job.id} ({job.kind}, стадия {job.stage})")
+            job.status = "queued"
+            job.stage = "recovered"
+            job_store.save(job, stage_changed=True)
+        self.jobs[job.id] = job
+        if job.key:
+            self._by_key[job.key] = job.id
+        self._queue.put_nowait((job, handler))
+
+    def submit(self, kind: str, params: Dict[str, Any], key: str | None = None) -> Job:
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"unknown job kind: {kind}")
+        if self._queue is None:
+            raise RuntimeError("job manager is not started")
+        self._prune()
+        # Повторный запрос с тем же ключом не должен покупать второй раз
+        if key and key in self._by_key and self._by_key[key] in self.jobs:
+            return self.jobs[self._by_key[key]]
+        if key:
+            existing = job_store.get_by_key(key)
+            if existing is not None:
+                return existing
+        if self.queue_depth >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFull(self.retry_after())
+        # Недостаток средств выясняется до Fragment и до подписи
+        cost = balance_ledger.estimate(kind, params)
+        balance_ledger.check(cost, 0.0 if self.leader else self._journal_reserved())
+        job = Job(kind, params, key)
+        # Сначала журнал: у ведомого процесса запись — единственная копия задания,
+        # и 202 без неё означал бы задание, которое никто не выполнит
+        try:
+            job_store.save(job, stage_changed=True, strict=True)
+        except IntegrityError:
+            # Тот же order_id одновременно принял другой процесс или воркер
+            existing = job_store.get_by_key(key) if key else None
+            if existing is not None:
+                return existing
+            raise RuntimeError("job journal write failed")
+        except Exception as e:
+            raise RuntimeError(f"job journal write failed: {e}")
+        if self.leader:
+            balance_ledger.reserve(job.id, cost)
+            self.jobs[job.id] = job
+            if key:
+                self._by_key[key] = job.id
+            self._queue.put_nowait((job, None))
+        self.stats["accepted"] += 1
+        return job
+
+    def _journal_reserved(self) -> float:
+        """Резервы ведущего процесса из памяти не видны, считаем их по журналу."""
+        return sum(balance_ledger.estimate(job.kind, job.params)
+                   for job in job_store.unfinished() if not job.tx_hash)
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id) or job_store.get(job_id)
+
+    def list(self, status: str | None = None, limit: int = 100) -> List[Job]:
+        if not self.leader:
+            return job_store.recent(status, limit)
+        jobs = [j for j in self.jobs.values() if status is None or j.status == status]
+        jobs.sort(key=lambda j: j.created_at, reverse=True)
+        return jobs[:limit]
+
+    @property
+    def queue_depth(self) -> int:
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() if self.leader else job_store.count("queued")
+
+    def retry_after(self) -> int:
+        """Секунды, за которые воркеры разберут текущую очередь при наблюдаемом времени выполнения."""
+        service_time = self.service_time or 30.0
+        return max(1, int(-(-(self.queue_depth + 1) * service_time // self.workers)))
+
+    def _observe(self, job: Job):
+        if job.started_at is None or job.finished_at is None:
+            return
+        duration = job.finished_at - job.started_at
+        if self.service_time is None:
+            self.service_time = duration
+        else:
+            self.service_time += PROVIDER_EWMA_ALPHA * (duration - self.service_time)
+
+    def snapshot(self) -> Dict[str, Any]:
+        running = [job for job in self.jobs.values() if job.status == "running"]
+        stages: Dict[str, int] = {}
+        for job in running:
+            stages[job.stage] = stages.get(job.stage, 0) + 1
+        return {
+            "role": "leader" if self.leader else "follower",
+            "pid": os.getpid(),
+            "queue_depth": self.queue_depth,
+            "max_queue": self.max_queue,
+            "workers": self.workers,
+            "running": len(running),
+            "stages": stages,
+            "limits": {
+                "fragment_per_shard": FRAGMENT_CONCURRENCY,
+                "wallet_in_flight_per_shard": WALLET_MAX_IN_FLIGHT,
+                "shards": {name: {"in_flight": shard.in_flight,
+                                  "wallet_slots_free": shard.wallet.in_flight._value,
+                                  "fragment_slots_free": shard.fragment.semaphore._value}
+                           for name, shard in shard_pool.shards.items()},
+            },
+            "service_time": self.service_time,
+            "retry_after": self.retry_after(),
+            "stats": dict(self.stats),
+        }
+
+    def _prune(self):
+        deadline = time.time() - self.ttl_seconds
+        stale = [j.id for j in self.jobs.values() if j.finished and (j.finished_at or 0) < deadline]
+        for job_id in stale:
+            job = self.jobs.pop(job_id)
+            if job.key:
+                self._by_key.pop(job.key, None)
+
+    async def _worker(self, index: int):
+        while True:
+            job, handler = await self._queue.get()
+            try:
+                await self._run(job, handler)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job, handler: Callable[[Job], Awaitable[Dict[str, Any]]] | None = None):
+        token = current_job.set(job)
+        job.status = "running"
+        job.started_at = job.started_at or time.time()
+        shard = None
+        try:
+            async with shard_pool.use(job.shard, balance_ledger.amount(job.id)) as shard:
+                job.shard = shard.name
+                balance_ledger.assign(job.id, shard)
+                set_job_stage("started")
+                raw_result = await (handler or JOB_HANDLERS[job.kind])(job)
+            result = compact_result(raw_result)
+            if result is not None and job.params.get("verbose"):
+                # Очистка от HTML делается один раз и только когда трассу действительно просили
+                result["trace"] = clean_and_filter(raw_result)
+            job.result = result
+            if result and result.get("tx_hash"):
+                job.tx_hash = result["tx_hash"]
+            if result and result.get("status") == "ok":
+                job.status = "done"
+            else:
+                job.status = "failed"
+                job.error = (result or {}).get("error") or "transaction failed"
+        except asyncio.CancelledError:
+            # Остановка процесса: задание не провалено, его подхватит recover() при следующем старте
+            job.status = "interrupted"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            spent = _spent_ton(job.result)
+            balance_ledger.release(job.id, shard, spent)
+            if job.status == "done":
+                balance_ledger.observe(job.kind, job.params, spent)
+            job.updated_at = time.time()
+            if job.finished:
+                job.stage = job.status
+                job.finished_at = job.updated_at
+                self._observe(job)
+                if job.result is not None:
+                    job.result["timings"] = job.timings()
+            job_store.save(job, stage_changed=True)
+            if job.finished:
+                job_notifier.finished(job)
+            current_job.reset(token)
+
+
+job_manager = JobManager()
+
+
+class JobNotifier:
+    """
+    Сообщает о заданиях без опроса: webhook при завершении (CALLBACK_URL или callback_url
+    из запроса) и поток server-sent events со сменами стадий и завершениями.
+    """
+
+    def __init__(self, retries: int = CALLBACK_RETRIES):
+        self.retries = retries
+        self._subscribers: List[asyncio.Queue] = []
+        self._deliveries: set[asyncio.Task] = set()
+        self.stats = {"published": 0, "dropped": 0, "callbacks_sent": 0, "callbacks_failed": 0}
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+
+    def publish(self, job: "Job"):
+        event = job.to_dict(with_result=job.finished)
+        self.stats["published"] += 1
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Медленный подписчик не должен тормозить задания
+                self.stats["dropped"] += 1
+
+    def finished(self, job: "Job"):
+        self.publish(job)
+        url = job.params.get("callback_url") or CALLBACK_URL
+        if not url:
+            return
+        task = asyncio.create_task(self._deliver(url, job.to_dict()))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, url: str, payload: Dict[str, Any]):
+        intervals = adaptive_intervals(1.0, 60.0, factor=2.0)
+        for attempt in range(1, self.retries + 1):
+            try:
+                async with http_sessions.get("callbacks").post(url, json=payload) as resp:
+                    if resp.status < 300:
+                        self.stats["callbacks_sent"] += 1
+                        return
+                    error = f"HTTP {resp.status}"
+            except Exception as e:
+                error = str(e)
+            print(f"Webhook задания {payload['job_id']} не доставлен ({attempt}/{self.retries}): {error}")
+            if attempt < self.retries:
+                await asyncio.sleep(next(intervals))
+        self.stats["callbacks_failed"] += 1
+
+    async def close(self):
+        # Даём недоставленным webhook'ам немного времени, остальные отменяем
+        if self._deliveries:
+            await asyncio.wait(list(self._deliveries), timeout=5)
+        for task in list(self._deliveries):
+            task.cancel()
+
+
+job_notifier = JobNotifier()
+
+
+async def wait_for_job(job_id: str, timeout: float) -> Job | None:
+    """
+    Ждёт завершения задания в этом же процессе. Задание другого процесса видно только
+    в журнале, поэтому раз в секунду проверяем и его.
+    """
+    queue = job_notifier.subscribe()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            job = job_manager.get(job_id)
+            if job is None or job.finished:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=min(1.0, remaining))
+            except asyncio.TimeoutError:
+                continue
+            if event["job_id"] == job_id and event["status"] in JOB_TERMINAL_STATUSES:
+                return job_manager.get(job_id)
+    finally:
+        job_notifier.unsubscribe(queue)
+
+
+def _submit_job(kind: str, params: Dict[str, Any], key: str | None) -> Job:
+    try:
+        return job_manager.submit(kind, params, key)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail="queue is full",
+                            headers={"Retry-After": str(e.retry_after)})
+    except RuntimeError as e:
+        # Менеджер заданий не запущен или останавливается
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except InsufficientBalance as e:
+        raise HTTPException(status_code=402, detail={"error": "insufficient_balance",
+                                                     "required_ton": e.required_ton,
+                                                     "available_ton": e.available_ton})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 
 class BuyRequest(BaseModel):
     login: str
     quantity: int
     hide_sender: int = 0
+    order_id: str | None = None
+    verbose: bool = False
+    callback_url: str | None = None
 
 
-@app.post("/buy")
+@app.post("/buy", status_code=202)
 async def buy_stars_endpoint(req: BuyRequest):
     if not req.login or req.quantity <= 0:
         raise HTTPException(status_code=400, detail="invalid input")
-    try:
-        result = await buy_stars_logic(req.login, req.quantity, req.hide_sender)
-        if not result:
-            raise HTTPException(status_code=500, detail="transaction failed")
-        return result
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    params = {"login": req.login, "quantity": req.quantity, "hide_sender": req.hide_sender, "verbose": req.verbose,
+              "callback_url": req.callback_url}
+    key = f"stars:{req.order_id}" if req.order_id else None
+    return _submit_job("stars", params, key).to_dict(with_result=False)
+
+
+class BuyBatchItem(BaseModel):
+    login: str
+    quantity: int
+    hide_sender: int = 0
+    order_id: str | None = None
+
+
+class BuyBatchRequest(BaseModel):
+    items: List[BuyBatchItem]
+    batch_id: str | None = None
+    verbose: bool = False
+    callback_url: str | None = None
+
+
+@app.post("/buy_batch", status_code=202)
+async def buy_batch_endpoint(req: BuyBatchRequest):
+    if not req.items or len(req.items) > BUY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"items: 1..{BUY_BATCH_MAX_ITEMS} required")
+    for item in req.items:
+        # Крупные заказы делятся на партии по STAR_BATCH_SIZE_1 и идут через /buy
+        if not item.login or not 0 < item.quantity <= STAR_BATCH_SIZE_1:
+            raise HTTPException(status_code=400, detail=f"invalid item: {item.login} x {item.quantity}")
+    params = {"items": [item.model_dump() for item in req.items], "verbose": req.verbose,
+              "callback_url": req.callback_url}
+    key = f"stars_batch:{req.batch_id}" if req.batch_id else None
+    return _submit_job("stars_batch", params, key).to_dict(with_result=False)
 
 
 class BuyPremiumRequest(BaseModel):
     login: str
     months: int
     hide_sender: int = 0
+    order_id: str | None = None
+    verbose: bool = False
+    callback_url: str | None = None
 
 
-@app.post("/buy_premium")
+@app.post("/buy_premium", status_code=202)
 async def buy_premium_endpoint(req: BuyPremiumRequest):
     if not req.login or req.months not in (3, 6, 12):
         raise HTTPException(status_code=400, detail="invalid input")
+    params = {"login": req.login, "months": req.months, "hide_sender": req.hide_sender, "verbose": req.verbose,
+              "callback_url": req.callback_url}
+    key = f"premium:{req.order_id}" if req.order_id else None
+    return _submit_job("premium", params, key).to_dict(with_result=False)
+
+
+@app.get("/providers")
+async def providers_endpoint():
+    return {
+        "seqno": seqno_providers.snapshot(),
+        "events": event_providers.snapshot(),
+        "watchers": {name: shard.watcher.snapshot() for name, shard in shard_pool.shards.items()},
+        "wallet_seqno": {name: shard.wallet.seqno.snapshot() for name, shard in shard_pool.shards.items()},
+    }
+
+
+@app.get("/shards")
+async def shards_endpoint():
+    return {"shards": shard_pool.snapshot()}
+
+
+@app.get("/ready")
+async def ready_endpoint():
+    if not readiness.ready:
+        return JSONResponse(status_code=503, content=readiness.snapshot())
+    return readiness.snapshot()
+
+
+@app.get("/queue")
+async def queue_endpoint():
+    return job_manager.snapshot()
+
+
+@app.get("/balance")
+async def balance_endpoint():
+    return balance_ledger.snapshot()
+
+
+@app.get("/recipients/stats")
+async def recipient_cache_endpoint():
+    return recipient_cache.snapshot()
+
+
+@app.get("/fragment")
+async def fragment_client_endpoint():
+    return {name: shard.fragment.snapshot() for name, shard in shard_pool.shards.items()}
+
+
+@app.get("/jobs")
+async def list_jobs_endpoint(status: str | None = None, limit: int = 100):
+    jobs = job_manager.list(status=status, limit=max(1, min(limit, 1000)))
+    return {"jobs": [j.to_dict(with_result=False) for j in jobs], "queue_depth": job_manager.queue_depth}
+
+
+def _sse(event: Dict[str, Any]) -> str:
+    return f"event: job\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+@app.get("/events")
+async def events_endpoint(job_id: str | None = None):
+    """
+    Поток server-sent events: смены стадий и завершения заданий.
+    С job_id поток ограничен одним заданием и закрывается после его завершения.
+    """
+    queue = job_notifier.subscribe()
+    # Подписка раньше проверки: завершение между ними не потеряется
+    job = job_manager.get(job_id) if job_id else None
+    if job_id and job is None:
+        job_notifier.unsubscribe(queue)
+        raise HTTPException(status_code=404, detail="job not found")
+
+    async def stream():
+        try:
+            if job is not None:
+                yield _sse(job.to_dict(with_result=job.finished))
+                if job.finished:
+                    return
+            while True:
+                # Задание выполняет другой процесс: его события сюда не приходят, журнал смотрим чаще
+                foreign = bool(job_id) and not job_manager.leader
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=1.0 if foreign else SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if foreign:
+                        stored = job_store.get(job_id)
+                        if stored is not None and stored.finished:
+                            yield _sse(stored.to_dict())
+                            return
+                    yield ": keepalive\n\n"
+                    continue
+                if job_id and event["job_id"] != job_id:
+                    continue
+                yield _sse(event)
+                if job_id and event["status"] in JOB_TERMINAL_STATUSES:
+                    return
+        finally:
+            job_notifier.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_endpoint(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+
+async def serve_http(host: str = os.getenv("HOST", "0.0.0.0"), port: int = EMBEDDED_HTTP_PORT):
+    """HTTP-интерфейс поверх уже запущенного purchase_engine (встроенный режим)."""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, lifespan="off"))
     try:
-        result = await buy_premium_logic(req.login, req.months, req.hide_sender)
-        if not result:
-            raise HTTPException(status_code=500, detail="transaction failed")
-        return result
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        await server.serve()
+    except SystemExit as e:
+        # Не заняв порт, uvicorn вызывает sys.exit: здесь это обычный сбой подсистемы, а не конец процесса
+        raise RuntimeError(f"HTTP server exited with code {e.code}")
+
 
 if __name__ == "__main__":
     import uvicorn
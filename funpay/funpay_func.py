@@ -1,22 +1,57 @@
 import asyncio
+import time
+from contextlib import contextmanager
 
 from FunPayAPI.account import Account
 from FunPayAPI.updater.runner import Runner
-from FunPayAPI.updater.events import NewMessageEvent
-from FunPayAPI.types import ChatShortcut
+from FunPayAPI.updater.events import NewMessageEvent, NewOrderEvent, InitialOrderEvent
+from FunPayAPI.types import ChatShortcut, OrderShortcut, OrderStatuses
 from data import FUNPAY_KEY, send_text
 from parse import parse_universal_string
-from models import SessionLocal, User
-from req import buy_stars
+from sqlalchemy import func
+
+from models import SessionLocal, Order
+from req import buy_stars, wait_for_job, get_job, use_embedded, close as close_purchase_client
 
 # Инициализация аккаунта FunPay
 account = Account(golden_key=FUNPAY_KEY)
 account.get()
 updater = Runner(account)
 
-# Множества для отслеживания обработанных заказов и чатов
+# Заказы, уже взятые в работу этим процессом, и чаты, в которые уже ответили
 processed_orders = set()
 responded_chats = set()
+# Заказы, которые прямо сейчас выполняет воркер или досылает follow_up_orders
+active_orders = set()
+
+# Страховочная сверка оплаченных заказов (сек): на случай, если событие Runner потерялось
+ORDER_SWEEP_INTERVAL = 300
+# Сколько заказов выполняется одновременно
+ORDER_CONCURRENCY = 5
+# Перезапуск упавшей подсистемы: пауза растёт от RESTART_DELAY до RESTART_MAX_DELAY (сек)
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = 60
+# Проработавшая столько секунд подсистема считается восстановившейся, пауза сбрасывается
+RESTART_STABLE_SECONDS = 300
+# Временный отказ сервиса покупки (402/429/503, сбой сети): повтор через Retry-After или ORDER_RETRY_DELAY (сек),
+# после ORDER_MAX_ATTEMPTS попыток заказ закрывается как failed. Неверный заказ (400/422) закрывается сразу
+ORDER_RETRY_DELAY = 60
+ORDER_MAX_ATTEMPTS = 20
+# Как часто перечитывать задания заказов, не подтвердившихся за время ожидания (сек)
+ORDER_FOLLOW_UP_INTERVAL = 60
+
+DONE_TEXT = '⭐️Звёзды уже на вашем аккаунте!⭐️\n\n ❗️Пожалуйста, подтвердите заказ.\n\n Так же будет очень приятно если оставите положительный отзыв за оперативность.'
+DELAYED_TEXT = '⏳ Отправка звёзд задерживается. Мы уже проверяем заказ и напишем вам, как только звёзды поступят.'
+FAILED_TEXT = '❌ Не удалось подтвердить отправку звёзд автоматически. Продавец проверит заказ вручную и напишет вам.'
+
+# Состояния заказа в журнале orders. Заказ в ORDER_FINAL_STATES повторно не выполняется;
+# "processing" после падения процесса и "rejected" можно повторить: сервис покупки узнает заказ по order_id.
+# "delayed" не выполняется заново, но follow_up_orders досылает покупателю итог его задания
+ORDER_FINAL_STATES = ("done", "delayed", "failed", "skipped", "legacy")
+
+# Заказы одного покупателя выполняются по очереди, разных — параллельно
+buyer_locks: dict[int | str, asyncio.Lock] = {}
+buyer_pending: dict[int | str, int] = {}
 
 
 def get_db():
@@ -28,25 +63,63 @@ def get_db():
         db.close()
 
 
-def user_exists(db, username: str) -> bool:
-    """Проверяет, есть ли пользователь уже в базе данных."""
-    return db.query(User).filter(User.username == username).first() is not None
+def order_finished(db, order_id: str) -> bool:
+    """Проверяет по журналу, выполнен ли уже заказ."""
+    return db.query(Order.id).filter(Order.id == order_id, Order.state.in_(ORDER_FINAL_STATES)).first() is not None
+
 
+def unfinished_order_ids(db, order_ids: list[str]) -> set[str]:
+    """Из списка заказов оставляет те, что ещё не выполнены (один запрос по первичному ключу)."""
+    finished = {row.id for row in db.query(Order.id).filter(Order.id.in_(order_ids),
+                                                            Order.state.in_(ORDER_FINAL_STATES))}
+    return set(order_ids) - finished
 
-def add_user(db, username: str):
-    """Добавляет нового пользователя в базу данных."""
-    new_user = User(username=username)
-    db.add(new_user)
+
+def claim_order(db, my_order: OrderShortcut) -> Order:
+    """Заводит заказ в журнале (или берёт существующий) и отмечает новую попытку."""
+    now = time.time()
+    order = db.get(Order, my_order.id)
+    if order is None:
+        order = Order(id=my_order.id, attempts=0, created_at=now)
+        db.add(order)
+    order.buyer_id = my_order.buyer_id
+    order.buyer_username = my_order.buyer_username
+    order.price = my_order.price
+    order.state = "processing"
+    order.attempts += 1
+    order.updated_at = now
     db.commit()
+    return order
+
+
+def update_order(db, order: Order, **fields):
+    """Сохраняет изменения заказа; state из ORDER_FINAL_STATES закрывает его."""
+    now = time.time()
+    for name, value in fields.items():
+        setattr(order, name, value)
+    order.updated_at = now
+    if order.state in ORDER_FINAL_STATES:
+        order.finished_at = now
+    db.commit()
+
 
+def orders_report(db) -> dict[str, int]:
+    """Количество заказов в журнале по состояниям."""
+    return dict(db.query(Order.state, func.count(Order.id)).group_by(Order.state).all())
 
-def blocking_events_handler():
+
+def blocking_events_handler(loop: asyncio.AbstractEventLoop, orders: asyncio.Queue):
     """
     Синхронный обработчик событий, который блокируется при ожидании новых событий.
     Должен выполняться в отдельном потоке.
+    Оплаченные заказы из событий Runner передаются гифтеру через очередь orders.
     """
     for event in updater.listen():
-        if isinstance(event, NewMessageEvent):
+        if isinstance(event, (InitialOrderEvent, NewOrderEvent)):
+            # Runner уже загрузил список продаж, отдельный запрос гифтеру не нужен
+            if event.order.status == OrderStatuses.PAID:
+                loop.call_soon_threadsafe(orders.put_nowait, event.order)
+        elif isinstance(event, NewMessageEvent):
             if event.message.author_id != account.id:
                 chat_id = event.message.chat_id
 
@@ -62,79 +135,259 @@ def blocking_events_handler():
                     print(f"Сообщение от {event.message.author} в чате {chat_id} проигнорировано (уже отвечали)")
 
 
-async def events_handler():
+async def events_handler(orders: asyncio.Queue):
     """
     Асинхронная обертка для запуска блокирующего обработчика событий в ThreadPoolExecutor.
     """
     loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, blocking_events_handler)
+    await loop.run_in_executor(None, blocking_events_handler, loop, orders)
 
 
-async def funpay_gifter():
+async def sweep_paid_orders(orders: asyncio.Queue):
     """
-    Основная логика обработки оплаченных заказов.
+    Страховочная сверка: раз в ORDER_SWEEP_INTERVAL ставит в очередь оплаченные,
+    но ещё не обработанные заказы. Основной источник заказов — события Runner.
     """
     while True:
+        await asyncio.sleep(ORDER_SWEEP_INTERVAL)
+        db = next(get_db())
         try:
-            a = account.get()
-            orders = a.get_sells(state='paid')
-            db = next(get_db())
-
-            if orders and orders[1]:
-                for my_order in reversed(orders[1]):
-                    id_sale = my_order.id
-
-                    # Двойная защита от повторной обработки заказа
-                    if id_sale in processed_orders or user_exists(db, id_sale):
-                        print(f'Заказ {id_sale} уже обработан или находится в обработке.')
-                        continue
-
-                    # Добавляем заказ в обрабатываемые сразу
-                    processed_orders.add(id_sale)
-
-                    try:
-                        print(f"Начинаю обработку заказа #{id_sale}")
-                        print(my_order.description)
-                        amount, buyer_name, count = parse_universal_string(my_order.description)
-                        print(f"Извлечено: amount={amount}, buyer_name={buyer_name}, count={count}")
-                        user_name = my_order.buyer_username
-                        print(user_name)
-                        chat_with_buyer: ChatShortcut = account.get_chat_by_name(name=str(user_name), make_request=True)
-                        print(chat_with_buyer)
-
-                        chat_id = chat_with_buyer.id
-                        try:
-                            amount = amount * count
-                        except TypeError:
-                            print(
-                                f"Не удалось рассчитать сумму для заказа #{id_sale} (amount={amount}, count={count}).")
-                            continue
-                        if float(amount) >10000:
-                            continue
-                        print(f"Отправляю {amount} звёзд пользователю {buyer_name}")
-                        a = buy_stars(login=buyer_name, quantity=amount)
-                        await asyncio.sleep(45)
-                        if a is not None:
-                            print(f"✅ Успешно отправлены звёзды для заказа #{id_sale}")
-                            print(a)
-                        else:
-                            print(f"❌ Возможно подарок не отправился для заказа #{id_sale}")
-
-                        account.send_message(chat_id=chat_id,
-                                             text='⭐️Звёзды уже на вашем аккаунте!⭐️\n\n ❗️Пожалуйста, подтвердите заказ.\n\n Так же будет очень приятно если оставите положительный отзыв за оперативность.')
-
-                        print(f"✅ Заказ #{id_sale} успешно обработан")
-
-                    except Exception as e:
-                        print(f"❌ Произошла ошибка при обработке заказа #{id_sale}: {e}")
-                    finally:
-                        print(f"--- Завершаю работу с заказом #{id_sale}, добавляю в БД. ---")
-                        add_user(db, id_sale)
+            # Синхронные запросы FunPayAPI — в поток: в этом же цикле работают воркеры и движок покупки
+            a = await asyncio.to_thread(account.get)
+            paid = await asyncio.to_thread(a.get_sells, state='paid')
+            if paid and paid[1]:
+                pending = unfinished_order_ids(db, [my_order.id for my_order in paid[1]])
+                for my_order in reversed(paid[1]):
+                    if my_order.id in pending and my_order.id not in processed_orders:
+                        orders.put_nowait(my_order)
+        except Exception as e:
+            print(f"Ошибка сверки оплаченных заказов: {e}")
+        finally:
+            db.close()
+
+
+@contextmanager
+def stage_timer(timings: dict, stage: str):
+    """Замеряет длительность стадии обработки заказа."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - started
+
+
+async def process_order(my_order: OrderShortcut, db) -> float | None:
+    """
+    Выдаёт звёзды по одному оплаченному заказу.
+    Возвращает паузу (сек), через которую заказ надо поставить в очередь снова,
+    если сервис покупки его временно отклонил или журнал заказов недоступен.
+    """
+    id_sale = my_order.id
+    timings = {}
+
+    # Двойная защита от повторной обработки заказа
+    if id_sale in processed_orders or id_sale in active_orders or order_finished(db, id_sale):
+        print(f'Заказ {id_sale} уже обработан или находится в обработке.')
+        return None
+
+    try:
+        order = claim_order(db, my_order)
+    except Exception as e:
+        # Заказ не заведён в журнале и не взят в работу: воркер поставит его в очередь снова
+        print(f"❌ Не удалось завести заказ #{id_sale} в журнале: {e}")
+        db.rollback()
+        return ORDER_RETRY_DELAY
+
+    # Между проверкой выше и этой строкой нет await: другой воркер не успеет взять тот же заказ
+    processed_orders.add(id_sale)
+    active_orders.add(id_sale)
+
+    try:
+        print(f"Начинаю обработку заказа #{id_sale}")
+        print(my_order.description)
+        with stage_timer(timings, "parse"):
+            amount, buyer_name, count = parse_universal_string(my_order.description)
+        print(f"Извлечено: amount={amount}, buyer_name={buyer_name}, count={count}")
+        update_order(db, order, login=buyer_name, parsed_at=time.time())
+        user_name = my_order.buyer_username
+        print(user_name)
+        # Синхронные запросы FunPayAPI уходят в поток, чтобы не останавливать остальные заказы
+        with stage_timer(timings, "chat"):
+            chat_with_buyer: ChatShortcut = await asyncio.to_thread(account.get_chat_by_name,
+                                                                    name=str(user_name), make_request=True)
+        print(chat_with_buyer)
+
+        chat_id = chat_with_buyer.id
+        try:
+            amount = amount * count
+        except TypeError:
+            print(
+                f"Не удалось рассчитать сумму для заказа #{id_sale} (amount={amount}, count={count}).")
+            update_order(db, order, state="failed", error=f"bad amount: amount={amount}, count={count}")
+            return
+        update_order(db, order, quantity=amount)
+        if float(amount) >10000:
+            update_order(db, order, state="skipped", error="quantity above limit")
+            return
+        print(f"Отправляю {amount} звёзд пользователю {buyer_name}")
+        with stage_timer(timings, "buy"):
+            job = await buy_stars(login=buyer_name, quantity=amount, order_id=str(id_sale))
+        if job.retryable and order.attempts < ORDER_MAX_ATTEMPTS:
+            delay = job.retry_after or ORDER_RETRY_DELAY
+            print(f"⏳ Заказ #{id_sale} отклонён сервисом покупки ({job.error}), повтор через {delay} с")
+            update_order(db, order, state="rejected", error=str(job.error))
+            if order.notified_at is None:
+                with stage_timer(timings, "notify"):
+                    await asyncio.to_thread(account.send_message, chat_id=chat_id, text=DELAYED_TEXT)
+                update_order(db, order, notified_at=time.time())
+            return delay
+        if job.accepted:
+            update_order(db, order, state="submitted", job_id=job.job_id, submitted_at=time.time())
+        # Ждём подтверждения транзакции, а не фиксированную паузу
+        with stage_timer(timings, "confirm"):
+            final = await wait_for_job(job.job_id) if job.accepted else job
+
+        if final is not None and final.done:
+            update_order(db, order, tx_hash=final.tx_hash, confirmed_at=time.time(), error=None)
+        else:
+            error = (final.error if final is not None else None) or "нет подтверждения"
+            update_order(db, order, error=str(error))
+
+        with stage_timer(timings, "notify"):
+            if final is not None and final.done:
+                print(f"✅ Успешно отправлены звёзды для заказа #{id_sale}")
+                await asyncio.to_thread(account.send_message, chat_id=chat_id, text=DONE_TEXT)
+                print(f"✅ Заказ #{id_sale} успешно обработан")
+            elif order.job_id:
+                print(f"❌ Звёзды для заказа #{id_sale} не подтверждены: {order.error}")
+                if final is not None:
+                    await asyncio.to_thread(account.send_message, chat_id=chat_id, text=FAILED_TEXT)
+                elif order.notified_at is None:
+                    # О задержке покупатель мог уже узнать при отказе сервиса покупки
+                    await asyncio.to_thread(account.send_message, chat_id=chat_id, text=DELAYED_TEXT)
             else:
-                print("Новых заказов нет.")
+                print(f"❌ Заказ #{id_sale} не принят сервисом покупки: {order.error}")
+                await asyncio.to_thread(account.send_message, chat_id=chat_id, text=FAILED_TEXT)
+        # delayed — задание ещё выполняется, итог дошлёт follow_up_orders; failed — задание провалено
+        # или сервис покупки так и не принял заказ
+        if order.confirmed_at:
+            state = "done"
+        elif order.job_id and final is None:
+            state = "delayed"
+        else:
+            state = "failed"
+        update_order(db, order, state=state, notified_at=time.time())
+        return None
+
+    except Exception as e:
+        print(f"❌ Произошла ошибка при обработке заказа #{id_sale}: {e}")
+        db.rollback()
+        update_order(db, order, state="failed", error=str(e))
+    finally:
+        active_orders.discard(id_sale)
+        print(f"--- Завершаю работу с заказом #{id_sale}: {order.state} ---")
+        if timings:
+            print(f"⏱ Заказ #{id_sale}: " + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in timings.items()))
+
+
+async def follow_up_order(db, order: Order):
+    """Перечитывает задание заказа и, если оно завершилось, сообщает итог покупателю."""
+    job = await get_job(order.job_id)
+    if job is None or job.status not in ("done", "failed"):
+        return
+    chat: ChatShortcut = await asyncio.to_thread(account.get_chat_by_name, name=str(order.buyer_username),
+                                                 make_request=True)
+    if job.done:
+        await asyncio.to_thread(account.send_message, chat_id=chat.id, text=DONE_TEXT)
+        update_order(db, order, state="done", tx_hash=job.tx_hash, confirmed_at=time.time(), error=None,
+                     notified_at=time.time())
+        print(f"✅ Заказ #{order.id} подтвердился позже, покупатель уведомлён")
+    else:
+        await asyncio.to_thread(account.send_message, chat_id=chat.id, text=FAILED_TEXT)
+        update_order(db, order, state="failed", error=str(job.error), notified_at=time.time())
+        print(f"❌ Задание заказа #{order.id} провалено: {job.error}")
+
+
+async def follow_up_orders():
+    """
+    Досылает итог заказам, которые не подтвердились за время ожидания (delayed),
+    и заказам, оставшимся в submitted после перезапуска.
+    """
+    while True:
+        await asyncio.sleep(ORDER_FOLLOW_UP_INTERVAL)
+        db = next(get_db())
+        try:
+            waiting = db.query(Order).filter(Order.state.in_(("delayed", "submitted")),
+                                             Order.job_id.isnot(None)).all()
+            for order in waiting:
+                if order.id in active_orders:
+                    continue
+                active_orders.add(order.id)
+                processed_orders.add(order.id)
+                try:
+                    await follow_up_order(db, order)
+                except Exception as e:
+                    db.rollback()
+                    print(f"Ошибка проверки заказа #{order.id}: {e}")
+                finally:
+                    active_orders.discard(order.id)
+        finally:
+            db.close()
+
+
+async def supervise(name: str, factory):
+    """
+    Держит подсистему запущенной: после падения или выхода перезапускает её с паузой.
+    Падение одной подсистемы не останавливает остальные.
+    """
+    delay = RESTART_DELAY
+    while True:
+        started = time.monotonic()
+        try:
+            await factory()
+            print(f"⚠️ Подсистема {name} завершилась, перезапуск через {delay} с")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Подсистема {name} упала: {e!r}. Перезапуск через {delay} с")
+        if time.monotonic() - started > RESTART_STABLE_SECONDS:
+            delay = RESTART_DELAY
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RESTART_MAX_DELAY)
+
+
+async def order_worker(orders: asyncio.Queue):
+    """Берёт заказы из очереди; заказ покупателя, у которого уже выполняется другой, ждёт своей очереди."""
+    while True:
+        my_order = await orders.get()
+        buyer = my_order.buyer_id or my_order.buyer_username
+        lock = buyer_locks.setdefault(buyer, asyncio.Lock())
+        buyer_pending[buyer] = buyer_pending.get(buyer, 0) + 1
+        db = next(get_db())
+        try:
+            async with lock:
+                retry_in = await process_order(my_order, db)
+            if retry_in:
+                processed_orders.discard(my_order.id)
+                asyncio.get_running_loop().call_later(retry_in, orders.put_nowait, my_order)
         except Exception as e:
             print(f"Ошибка в основном цикле: {e}")
-        await asyncio.sleep(60)
+        finally:
+            db.close()
+            buyer_pending[buyer] -= 1
+            if not buyer_pending[buyer]:
+                del buyer_pending[buyer]
+                del buyer_locks[buyer]
+            orders.task_done()
+
+
+async def funpay_gifter(orders: asyncio.Queue):
+    """
+    Основная логика обработки оплаченных заказов.
+    Заказы приходят из очереди: их кладут события Runner и страховочная сверка.
+    Одновременно выполняется до ORDER_CONCURRENCY заказов.
+    """
+    await asyncio.gather(*(supervise(f"worker-{i}", lambda: order_worker(orders)) for i in range(ORDER_CONCURRENCY)))
 
 
 async def unverif_orders():
@@ -142,18 +395,42 @@ async def unverif_orders():
     orders = a.get_sells(state='paid')
     db = next(get_db())
 
-    for my_order in reversed(orders[1]):
-        ids = my_order.id
-        print(ids)
+    try:
+        for my_order in reversed(orders[1]):
+            ids = my_order.id
+            order = db.get(Order, ids)
+            print(ids, order.state if order is not None else "нет в журнале")
+        print("Журнал заказов:", orders_report(db))
+    finally:
+        db.close()
 
 
-async def start_funpay_gifter():
-    """
-    Запускает обе задачи: обработчик сообщений и обработчик заказов.
-    """
+async def run_subsystems(orders: asyncio.Queue, *extra):
+    await asyncio.gather(
+        supervise("listener", lambda: events_handler(orders)),
+        supervise("gifter", lambda: funpay_gifter(orders)),
+        supervise("sweep", lambda: sweep_paid_orders(orders)),
+        supervise("follow-up", follow_up_orders),
+        *extra,
+    )
 
-    listener_task = asyncio.create_task(events_handler())
-    gifter_task = asyncio.create_task(funpay_gifter())
 
-    await asyncio.gather(listener_task, gifter_task)
+async def start_funpay_gifter(embedded: bool = False):
+    """
+    Запускает обработчик событий (сообщения и новые заказы), обработчик заказов и страховочную сверку.
+    embedded=True поднимает движок покупки api.py в этом же процессе и ставит задания напрямую;
+    HTTP-интерфейс тогда запускается, только если задан EMBEDDED_HTTP_PORT.
+    """
 
+    orders = asyncio.Queue()
+    try:
+        if not embedded:
+            await run_subsystems(orders)
+            return
+        import api
+        async with api.purchase_engine():
+            use_embedded(api)
+            extra = [supervise("http", api.serve_http)] if api.EMBEDDED_HTTP_PORT else []
+            await run_subsystems(orders, *extra)
+    finally:
+        await close_purchase_client()
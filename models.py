@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine, Column, Integer, String
+import time
+
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, Integer, String, Float, Text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -6,15 +8,125 @@ from sqlalchemy.ext.declarative import declarative_base
 DATABASE_URL = "sqlite:///./users.db"
 
 # Boilerplate SQLAlchemy setup
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# Define the table to store users
-class User(Base):
-    __tablename__ = "users"
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, unique=True, index=True)
 
-# Create the database and the 'users' table
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL: readers never block the writer, and a crash loses at most the last commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-8000")
+    cursor.close()
+
+
+event.listen(engine, "connect", _set_sqlite_pragmas)
+
+
+# Ledger of FunPay orders: one row per order, updated as it moves through fulfillment
+class Order(Base):
+    __tablename__ = "orders"
+    id = Column(String, primary_key=True)
+    buyer_id = Column(Integer, nullable=True)
+    buyer_username = Column(String, nullable=True)
+    login = Column(String, nullable=True)
+    quantity = Column(Integer, nullable=True)
+    price = Column(Float, nullable=True)
+    state = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    job_id = Column(String, nullable=True)
+    tx_hash = Column(String, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    parsed_at = Column(Float, nullable=True)
+    submitted_at = Column(Float, nullable=True)
+    confirmed_at = Column(Float, nullable=True)
+    notified_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+
+    __table_args__ = (
+        Index("ix_orders_state_created_at", "state", "created_at"),
+        Index("ix_orders_buyer_id_created_at", "buyer_id", "created_at"),
+    )
+
+
+# Create the database and the 'orders' table
+Base.metadata.create_all(bind=engine)
+
+
+# The old 'users' table held processed order ids in 'username'; carry them over as finished orders
+def _migrate_legacy_users(engine):
+    if not inspect(engine).has_table("users"):
+        return
+    now = time.time()
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT OR IGNORE INTO orders (id, state, attempts, created_at, updated_at, finished_at) "
+            "SELECT username, 'legacy', 1, :now, :now, :now FROM users WHERE username IS NOT NULL"
+        ), {"now": now})
+        conn.execute(text("DROP TABLE users"))
+
+
+_migrate_legacy_users(engine)
+
+
+# create_all does not alter existing tables, so columns added to 'orders' later are appended here
+def _add_missing_columns(engine, table, columns):
+    existing = {column["name"] for column in inspect(engine).get_columns(table)}
+    with engine.begin() as conn:
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+# Journal of purchase jobs for api.py, kept in its own file 'jobs.db'
+JOBS_DATABASE_URL = "sqlite:///./jobs.db"
+
+jobs_engine = create_engine(JOBS_DATABASE_URL, connect_args={"check_same_thread": False})
+JobsSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=jobs_engine)
+JobsBase = declarative_base()
+
+
+event.listen(jobs_engine, "connect", _set_sqlite_pragmas)
+
+
+# One row per purchase job, updated on every stage transition
+class FulfillmentJob(JobsBase):
+    __tablename__ = "fulfillment_jobs"
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    idempotency_key = Column(String, unique=True, index=True, nullable=True)
+    params = Column(Text, nullable=False)
+    status = Column(String, index=True, nullable=False)
+    stage = Column(String, nullable=False)
+    req_id = Column(String, nullable=True)
+    tx_hash = Column(String, nullable=True)
+    # Hash of the serialized message cell, as it appears in the wallet transaction stream
+    raw_hash = Column(String, nullable=True)
+    seqno = Column(Integer, nullable=True)
+    shard = Column(String, nullable=True)
+    progress = Column(Text, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    started_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+
+
+# Append-only log of stage transitions
+class FulfillmentJobStage(JobsBase):
+    __tablename__ = "fulfillment_job_stages"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, index=True, nullable=False)
+    stage = Column(String, nullable=False)
+    tx_hash = Column(String, nullable=True)
+    at = Column(Float, nullable=False)
+
+
+JobsBase.metadata.create_all(bind=jobs_engine)
@@ -1,43 +1,217 @@
-import subprocess
+import asyncio
 import json
+from typing import Any, Dict
 
+import aiohttp
 
-def buy_stars(login: str, quantity: int, hide_sender: int = 0):
+API_URL = "http://localhost:80"
+# Таймаут на создание задания: /buy отвечает 202 сразу, долго ждать нечего
+API_TIMEOUT = 15
+# Сколько ждать подтверждения задания по /events (сек)
+JOB_WAIT_TIMEOUT = 900
+# Keep-alive соединения к сервису покупки
+API_CONNECTIONS = 10
+API_KEEPALIVE_SECONDS = 60
+# Временные отказы сервиса покупки: заказ стоит отправить ещё раз позже
+RETRYABLE_HTTP_STATUSES = (402, 429, 502, 503, 504)
+
+
+class JobResult:
     """
-    Отправляет запрос на сервер, исполняя curl команду в консоли.
+    Ответ сервиса покупки: созданное задание или отказ.
+    Отказ (402 — не хватает баланса, 429 — очередь полна, 503 — сервис не готов) приходит без job_id.
+    Остальные отказы (400, 422 — неверный заказ) повторять бесполезно.
     """
-    api_url = "http://localhost:80/buy"
 
-    payload = {
-        "login": login,
-        "quantity": quantity,
-        "hide_sender": hide_sender
-    }
-    payload_str = json.dumps(payload)
+    def __init__(self, job_id: str | None = None, status: str | None = None, error: Any = None,
+                 tx_hash: str | None = None, result: Dict[str, Any] | None = None,
+                 http_status: int | None = None, retry_after: float | None = None):
+        self.job_id = job_id
+        self.status = status
+        self.error = error
+        self.tx_hash = tx_hash
+        self.result = result
+        self.http_status = http_status
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_job(cls, data: Dict[str, Any], http_status: int | None = None) -> "JobResult":
+        return cls(job_id=data.get("job_id"), status=data.get("status"), error=data.get("error"),
+                   tx_hash=data.get("tx_hash"), result=data.get("result"), http_status=http_status)
+
+    @property
+    def accepted(self) -> bool:
+        return self.job_id is not None
+
+    @property
+    def done(self) -> bool:
+        return self.status == "done"
+
+    @property
+    def retryable(self) -> bool:
+        """Отказ временный; ошибка сети приходит без http_status и тоже повторяется."""
+        return not self.accepted and (self.http_status is None or self.http_status in RETRYABLE_HTTP_STATUSES)
+
+    @property
+    def failed(self) -> bool:
+        return self.status == "failed" or not self.accepted
+
+    def __repr__(self) -> str:
+        return f"JobResult(job_id={self.job_id!r}, status={self.status!r}, error={self.error!r})"
+
+
+class PurchaseClient:
+    """
+    Асинхронный клиент сервиса покупки. Одна aiohttp-сессия с keep-alive на весь процесс
+    вместо запуска curl на каждый заказ.
+    """
+
+    def __init__(self, base_url: str = API_URL, timeout: float = API_TIMEOUT, limit: int = API_CONNECTIONS):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.limit = limit
+        self._session: aiohttp.ClientSession | None = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=API_KEEPALIVE_SECONDS)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def buy_stars(self, login: str, quantity: int, hide_sender: int = 0,
+                        order_id: str | None = None) -> JobResult:
+        """Создаёт задание на покупку звёзд. Не бросает исключений: ошибка сети тоже вернётся как отказ."""
+        payload = {"login": login, "quantity": quantity, "hide_sender": hide_sender}
+        if order_id is not None:
+            # Повторная отправка того же заказа не купит звёзды второй раз
+            payload["order_id"] = order_id
+
+        print(f"🚀 Создаю задание: {payload}")
+        try:
+            async with self._get_session().post(f"{self.base_url}/buy", json=payload) as resp:
+                try:
+                    data = await resp.json(content_type=None)
+                except json.JSONDecodeError:
+                    print(f"❌ Сервер вернул не JSON (HTTP {resp.status})")
+                    return JobResult(status="rejected", error="invalid response", http_status=resp.status)
+                if resp.status == 202 and isinstance(data, dict) and "job_id" in data:
+                    print(f"✅ Задание {data['job_id']} создано")
+                    return JobResult.from_job(data, http_status=resp.status)
+                retry_after = resp.headers.get("Retry-After")
+                detail = data.get("detail") if isinstance(data, dict) else data
+                print(f"❌ Сервер отклонил заказ (HTTP {resp.status}): {detail}")
+                return JobResult(status="rejected", error=detail, http_status=resp.status,
+                                 retry_after=float(retry_after) if retry_after else None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"❌ Сервис покупки недоступен: {e!r}")
+            return JobResult(status="rejected", error=repr(e))
+
+    async def wait_for_job(self, job_id: str, timeout: float = JOB_WAIT_TIMEOUT) -> JobResult | None:
+        """
+        Ждёт завершения задания по потоку событий /events и возвращает его финальное состояние.
+        None — если за timeout секунд задание не завершилось или поток оборвался.
+        """
+        try:
+            async with self._get_session().get(f"{self.base_url}/events", params={"job_id": job_id},
+                                               timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                if resp.status != 200:
+                    print(f"❌ Не удалось подписаться на задание {job_id} (HTTP {resp.status})")
+                    return None
+                async for raw in resp.content:
+                    line = raw.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[len("data:"):])
+                    if event.get("status") in ("done", "failed"):
+                        return JobResult.from_job(event)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"❌ Ожидание задания {job_id} прервано: {e!r}")
+        return None
+
+    async def get_job(self, job_id: str) -> JobResult | None:
+        """Текущее состояние задания без ожидания; None — если сервис недоступен или задания нет."""
+        try:
+            async with self._get_session().get(f"{self.base_url}/jobs/{job_id}") as resp:
+                if resp.status != 200:
+                    return None
+                return JobResult.from_job(await resp.json(content_type=None), http_status=resp.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"❌ Не удалось получить задание {job_id}: {e!r}")
+            return None
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class EmbeddedClient:
+    """
+    Тот же интерфейс, но задания ставятся прямо в движок api.py в этом же процессе:
+    без HTTP-запроса и JSON в обе стороны. Движок должен быть запущен (api.purchase_engine).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def buy_stars(self, login: str, quantity: int, hide_sender: int = 0,
+                        order_id: str | None = None) -> JobResult:
+        engine = self.engine
+        params = {"login": login, "quantity": quantity, "hide_sender": hide_sender, "verbose": False,
+                  "callback_url": None}
+        key = f"stars:{order_id}" if order_id else None
+        print(f"🚀 Создаю задание: {params}")
+        try:
+            job = engine.job_manager.submit("stars", params, key)
+        except engine.QueueFull as e:
+            print("❌ Очередь заданий заполнена")
+            return JobResult(status="rejected", error="queue is full", http_status=429, retry_after=e.retry_after)
+        except engine.InsufficientBalance as e:
+            print(f"❌ Не хватает баланса: нужно {e.required_ton} TON, доступно {e.available_ton} TON")
+            return JobResult(status="rejected", http_status=402,
+                             error={"error": "insufficient_balance", "required_ton": e.required_ton,
+                                    "available_ton": e.available_ton})
+        except RuntimeError as e:
+            print(f"❌ Движок покупки не готов: {e}")
+            return JobResult(status="rejected", error=str(e), http_status=503, retry_after=5)
+        print(f"✅ Задание {job.id} создано")
+        return JobResult.from_job(job.to_dict(with_result=False))
+
+    async def wait_for_job(self, job_id: str, timeout: float = JOB_WAIT_TIMEOUT) -> JobResult | None:
+        job = await self.engine.wait_for_job(job_id, timeout)
+        if job is None or not job.finished:
+            return None
+        return JobResult.from_job(job.to_dict())
+
+    async def get_job(self, job_id: str) -> JobResult | None:
+        job = self.engine.job_manager.get(job_id)
+        return JobResult.from_job(job.to_dict()) if job is not None else None
+
+    async def close(self):
+        pass
+
+
+purchase_client: PurchaseClient | EmbeddedClient = PurchaseClient()
+
+
+def use_embedded(engine):
+    """Переключает buy_stars/wait_for_job на движок в этом же процессе."""
+    global purchase_client
+    purchase_client = EmbeddedClient(engine)
+
 
-    command = [
-        "curl",
-        "-X", "POST",
-        api_url,
-        "-H", "Content-Type: application/json",
-        "-d", payload_str
-    ]
+async def close():
+    await purchase_client.close()
 
-    print(f"🚀 Выполняю команду в консоли: {' '.join(command)}")
 
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True, shell=True, encoding='utf-8')
+async def buy_stars(login: str, quantity: int, hide_sender: int = 0, order_id: str | None = None) -> JobResult:
+    return await purchase_client.buy_stars(login, quantity, hide_sender, order_id)
 
-        print("✅ Ответ от сервера:")
-        print(result.stdout)
 
-    except subprocess.CalledProcessError as e:
-        print(e.stdout)
-        print("--- Вывод stderr ---")
-        print(e.stderr)
-    except FileNotFoundError:
-        print("❌ ОШИБКА: Команда 'curl' не найдена. Убедись, что curl установлен и доступен в PATH Windows.")
-    except Exception as e:
-        print(f"❌ Произошла непредвиденная ошибка: {e}")
+async def wait_for_job(job_id: str, timeout: float = JOB_WAIT_TIMEOUT) -> JobResult | None:
+    return await purchase_client.wait_for_job(job_id, timeout)
 
 
+async def get_job(job_id: str) -> JobResult | None:
+    return await purchase_client.get_job(job_id)
@@ -2,6 +2,18 @@ import asyncio
 import time
 from funpay.funpay_func import funpay_gifter, start_funpay_gifter, unverif_orders
 
+try:
+    import uvloop
+except ImportError:  # Windows или uvloop не установлен
+    uvloop = None
+
+
+def run(coro):
+    """Запускает корутину на uvloop, если он есть, иначе на стандартном цикле asyncio."""
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
 
 def show_menu():
     """Отображает главное меню."""
@@ -9,8 +21,9 @@ def show_menu():
     print("║              Главное меню            ║")
     print("╠══════════════════════════════════════╣")
     print("║ 1. Запустить основной скрипт         ║")
-    print("║ 2. Ид заказов                        ║")
-    print("║ 3. Выход                             ║")
+    print("║ 2. Запустить всё в одном процессе    ║")
+    print("║ 3. Ид заказов                        ║")
+    print("║ 4. Выход                             ║")
     print("╚══════════════════════════════════════╝")
 
 def main():
@@ -21,31 +34,33 @@ def main():
 
     while True:
         show_menu()
-        choice = input("Выберите опцию (1-3): ")
+        choice = input("Выберите опцию (1-4): ")
 
-        if choice == '1':
+        if choice in ('1', '2'):
             try:
-                asyncio.run(start_funpay_gifter())
+                run(start_funpay_gifter(embedded=choice == '2'))
             except KeyboardInterrupt:
                 print("\n✅ Скрипт остановлен пользователем. Возврат в главное меню...")
             except Exception as e:
                 print(f"\n❌ Произошла непредвиденная ошибка в скрипте: {e}")
                 time.sleep(5)
-        elif choice == '2':
-            asyncio.run(unverif_orders())
         elif choice == '3':
+            asyncio.run(unverif_orders())
+        elif choice == '4':
             print("\n👋 До свидания!")
             break
         elif choice.lower() == 'help':
              print("\n--- Помощь ---")
              print("Это простое меню для управления скриптом.")
              print("1. Запустить основной скрипт: запускает процесс обработки заказов FunPay.")
-             print("2. Ид заказов: выведет неподтверждённые заказы.")
-             print("3. Выход: завершает программу.")
-             print("ДЛЯ РАБОТЫ СКРИПТА НЕ ЗАБЫВАЕМ ЗАПУСТИТЬ ФАЙЛ API.PY")
+             print("   ДЛЯ РАБОТЫ СКРИПТА НЕ ЗАБЫВАЕМ ЗАПУСТИТЬ ФАЙЛ API.PY")
+             print("2. Запустить всё в одном процессе: FunPay и покупка звёзд без отдельного API.PY.")
+             print("   HTTP-интерфейс включается переменной EMBEDDED_HTTP_PORT в .env.")
+             print("3. Ид заказов: выведет неподтверждённые заказы.")
+             print("4. Выход: завершает программу.")
              input("\nНажмите Enter, чтобы вернуться в меню...")
         else:
-            print("\n❗️ Неверный выбор. Пожалуйста, выберите опцию от 1 до 3.")
+            print("\n❗️ Неверный выбор. Пожалуйста, выберите опцию от 1 до 4.")
             time.sleep(2)
 
 